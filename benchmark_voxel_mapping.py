@@ -0,0 +1,284 @@
+'''
+Benchmark of run_long_suvr_voxel_mapping.py on synthetic phantoms
+
+Generates NIfTI phantoms for each ROI size (midpoint parcellation with a
+spherical cerebellum split into the GIF cerebellar labels, GIF-style tissue
+segmentation, a mask-file region overlapping it, smooth SPM-style deformation
+fields to baseline and followup, T1 -> PET rigid affines, 2mm PET volumes with
+injected outlier voxels), then runs the mapping script itself on them, as the
+batch runner does, in each configuration of CONFIGS: nearest and trilinear
+sampling, full and lean loading, a stage cache hit, NIfTI and sparse
+correspondence output, with the three reference regions mapped in one pass.
+Stage times are read from the script's run report.
+
+The output files of each run are hashed (image data of the masks, table and
+correspondence contents) and checked against benchmark_reference.json, the LTS
+fit values to rtol 1e-6, so an optimisation can be shown to be faster and to
+give the same outputs. Runs that must give the same outputs as another (lean
+loading, cache hit) are also checked against it. --update_reference rewrites
+the reference.
+
+usage: python benchmark_voxel_mapping.py [--sizes 1000 10000 100000 1000000] [--configs nearest lean]
+'''
+import argparse
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import numpy as np
+import nibabel as nib
+import pandas as pd
+from ref_masks import REF_ROI_TABLE
+from stage_report import REPORT_SUFFIX
+from run_long_suvr_voxel_mapping_batch import run_job
+
+REFERENCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_reference.json')
+SIZES = [1000, 10000, 100000, 1000000]
+#fraction of PET voxels made hot in the followup
+OUTLIER_FRACTION = 0.02
+RTOL = 1e-6
+REF_ROIS = ['cereb', 'gm-cereb-clean', 'wm-subcort-gif3']
+#run_long_suvr_voxel_mapping.py arguments of each benchmark run, in run order
+#(cached reuses the mapping stored by nearest)
+CONFIGS = {
+    'nearest': ['--sampling', 'nearest', '--load_mode', 'full', '--mask_output', 'both', '--cache', 'refresh'],
+    'lean': ['--sampling', 'nearest', '--load_mode', 'lean', '--mask_output', 'nifti', '--cache', 'off'],
+    'cached': ['--sampling', 'nearest', '--load_mode', 'full', '--mask_output', 'both', '--cache', 'on'],
+    'trilinear': ['--sampling', 'trilinear', '--load_mode', 'lean', '--mask_output', 'both', '--cache', 'off'],
+}
+#runs whose outputs must equal another run's (the files both write)
+SAME_AS = {'lean': 'nearest', 'cached': 'nearest'}
+
+
+def _rotation_z(deg):
+    t = np.deg2rad(deg)
+    rot = np.eye(4)
+    rot[:2, :2] = [[np.cos(t), -np.sin(t)], [np.sin(t), np.cos(t)]]
+    return rot
+
+
+def make_phantom(phantom_dir, nvox, seed=0):
+    '''
+    write the phantom for a ROI of about nvox voxels to phantom_dir (kept and
+    reused), returns dict of file paths
+    '''
+    files = {name: os.path.join(phantom_dir, name + ext) for name, ext in
+             (('par', '.nii.gz'), ('seg', '.nii.gz'), ('roi_mask', '.nii.gz'),
+              ('bl_def', '.nii.gz'), ('fu_def', '.nii.gz'),
+              ('bl_pet', '.nii.gz'), ('fu_pet', '.nii.gz'), ('bl_aff', '.txt'), ('fu_aff', '.txt'))}
+    if all(os.path.exists(path) for path in files.values()):
+        return files
+    os.makedirs(phantom_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    #1mm midpoint grid around a sphere of nvox voxels
+    radius = (3.0 * nvox / (4.0 * np.pi)) ** (1.0 / 3.0)
+    side = int(np.ceil(2 * radius)) + 12
+    mid_affine = np.diag([1.0, 1.0, 1.0, 1.0])
+    mid_affine[:3, 3] = -side / 2.0
+    ijk = np.stack(np.meshgrid(*[np.arange(side)] * 3, indexing='ij'), axis=-1).astype(np.float32)
+    centre = (side - 1) / 2.0
+    rel = ijk - centre
+    inside = (rel ** 2).sum(axis=-1) <= radius ** 2
+    #split the sphere into the cerebellar labels by octant, label 5 outside
+    labels = np.array(REF_ROI_TABLE['cereb']['labels'] + [39])
+    octant = (rel[..., 0] > 0) * 4 + (rel[..., 1] > 0) * 2 + (rel[..., 2] > 0)
+    par = np.where(inside, labels[octant], 5).astype(np.float32)
+    nib.save(nib.Nifti1Image(par, mid_affine), files['par'])
+
+    #GIF-style segmentation, x,y,z,1,tissue, the GM probability (tissue 2) is
+    #banded so gm-cereb-clean keeps part of its labels
+    tissue = REF_ROI_TABLE['gm-cereb-clean']['tissue']
+    seg = np.zeros((side, side, side, 1, tissue + 1), dtype=np.float32)
+    seg[..., 0, tissue] = 0.8 + 0.2 * np.sin(6 * np.pi * rel[..., 2] / side)
+    nib.save(nib.Nifti1Image(seg, mid_affine), files['seg'])
+    del seg
+    #mask-file region (wm-subcort-gif3), a smaller sphere half inside the cerebellum
+    shifted = rel - [radius / 2.0, 0, 0]
+    roi_mask = ((shifted ** 2).sum(axis=-1) <= (radius / 2.0) ** 2).astype(np.uint8)
+    nib.save(nib.Nifti1Image(roi_mask, mid_affine), files['roi_mask'])
+    del shifted, roi_mask
+
+    #smooth deformations (mm), x,y,z,1,3 as SPM y_ fields
+    mm = ijk.dot(mid_affine[:3, :3].T) + mid_affine[:3, 3]
+    for tp, phase in (('bl', 0.0), ('fu', 1.0)):
+        disp = 1.5 * np.sin(2 * np.pi * rel[..., [1, 2, 0]] / max(side, 20) + phase)
+        def_data = (mm + disp).astype(np.float32)[:, :, :, np.newaxis, :]
+        nib.save(nib.Nifti1Image(def_data, mid_affine), files[tp + '_def'])
+    del ijk, rel, mm, def_data
+
+    #T1 -> PET rigid affines and 2mm PET grids covering the midpoint volume
+    pet_side = side // 2 + 6
+    pet_affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    pet_affine[:3, 3] = -pet_side
+    pet_ijk = np.stack(np.meshgrid(*[np.arange(pet_side)] * 3, indexing='ij'), axis=-1)
+    smooth = 5000 + 500 * np.sin(2 * np.pi * pet_ijk / pet_side).sum(axis=-1)
+    for tp, deg, shift, scale in (('bl', 2.0, 1.5, 1.0), ('fu', -3.0, -1.0, 1.03)):
+        aff = _rotation_z(deg)
+        aff[:3, 3] = shift
+        np.savetxt(files[tp + '_aff'], aff)
+        pet = scale * smooth + rng.normal(0, 100, smooth.shape)
+        if tp == 'fu':
+            hot = rng.random(smooth.shape) < OUTLIER_FRACTION
+            pet[hot] *= 1.5
+        nib.save(nib.Nifti1Image(pet.astype(np.float32), pet_affine), files[tp + '_pet'])
+    return files
+
+
+def _sha(arr):
+    return hashlib.sha256(np.ascontiguousarray(arr).tobytes()).hexdigest()[:16]
+
+
+def run_config(files, root_dir, cache_dir, config):
+    '''
+    run run_long_suvr_voxel_mapping.py on a phantom in this process with the
+    arguments of CONFIGS[config], outputs under root_dir
+    returns (error, report) with the script's run report
+    '''
+    argv = ['--subject', 'bench',
+            '--bl_def', files['bl_def'], '--bl_aff', files['bl_aff'],
+            '--fu_def', files['fu_def'], '--fu_aff', files['fu_aff'],
+            '--mid_par', files['par'], '--mid_seg', files['seg'],
+            '--bl_pet', files['bl_pet'], '--fu_pet', files['fu_pet'],
+            '--ref_roi'] + REF_ROIS + ['--ref_roi_mask', 'wm-subcort-gif3=' + files['roi_mask'],
+            '--alpha', '0.75', '--lts_path', 'warm', '--root_dir', root_dir,
+            '--cache_dir', cache_dir] + CONFIGS[config]
+    _, error, _ = run_job(config, root_dir, argv, os.path.join(root_dir, config + '.log'))
+    report_file = os.path.join(root_dir, 'sub-bench', 'ses-midpoint', 'pet',
+                               'sub-bench_ses-midpoint_long_voxel_mapping' + REPORT_SUFFIX)
+    report = None
+    if error is None:
+        with open(report_file) as f:
+            report = json.load(f)
+    return error, report
+
+
+def hash_outputs(root_dir):
+    '''
+    check values of the outputs under root_dir: hash of the image data of each
+    mask, of the contents of each table and correspondence file, and the LTS
+    fit values of each region, keyed by file name
+    '''
+    result = {}
+    for dir_path, _, names in os.walk(os.path.join(root_dir, 'sub-bench')):
+        for name in sorted(names):
+            path = os.path.join(dir_path, name)
+            if name.endswith(REPORT_SUFFIX):
+                continue
+            if name.endswith('_LTS_summary.csv'):
+                summary = pd.read_csv(path)
+                result[name] = summary[['alpha', 'rsquared', 'intercept', 'slope']].to_numpy().ravel().tolist()
+            elif name.endswith('.nii.gz'):
+                data = np.asanyarray(nib.load(path).dataobj)
+                result[name] = _sha(data.astype(data.dtype.newbyteorder('=')))
+            elif name.endswith('.npz'):
+                with np.load(path) as npz:
+                    result[name] = _sha(np.concatenate([np.frombuffer(_sha(npz[k]).encode(), np.uint8)
+                                                        for k in sorted(npz.files)]))
+            else:
+                with open(path, 'rb') as f:
+                    result[name] = hashlib.sha256(f.read()).hexdigest()[:16]
+    return result
+
+
+def compare(result, ref):
+    #names of check values (files) that differ from the reference
+    bad = []
+    for key, value in ref.items():
+        if key not in result:
+            bad.append(key)
+        elif isinstance(value, list):
+            if not np.allclose(result[key], value, rtol=RTOL, atol=0):
+                bad.append(key)
+        elif result[key] != value:
+            bad.append(key)
+    return bad
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES,
+                        help='ROI sizes (voxels)')
+    parser.add_argument('--phantom_dir', type=str, default='benchmark_phantoms',
+                        help='where phantoms are written and reused')
+    parser.add_argument('--configs', type=str, nargs='+', choices=list(CONFIGS), default=list(CONFIGS),
+                        help='script configurations run per size (cached is a cache hit only after nearest)')
+    parser.add_argument('--repeats', type=int, default=1,
+                        help='runs per size, the fastest is reported')
+    parser.add_argument('--update_reference', action='store_true',
+                        help='store these results as the reference')
+    parser.add_argument('--json', type=str,
+                        help='also write the timings as json')
+    args = parser.parse_args()
+
+    reference = {}
+    if os.path.exists(REFERENCE):
+        with open(REFERENCE) as f:
+            reference = json.load(f)
+
+    rows = []
+    failed = False
+    for size in args.sizes:
+        files = make_phantom(os.path.join(args.phantom_dir, 'roi-' + str(size)), size)
+        best = {}
+        results = {}
+        errors = {}
+        for _ in range(args.repeats):
+            #fresh outputs and stage cache per repeat, configs in CONFIGS order
+            with tempfile.TemporaryDirectory() as work_dir:
+                cache_dir = os.path.join(work_dir, 'stage_cache')
+                for config in args.configs:
+                    root_dir = os.path.join(work_dir, config)
+                    error, report = run_config(files, root_dir, cache_dir, config)
+                    if error is not None:
+                        with open(os.path.join(root_dir, config + '.log')) as f:
+                            errors[config] = error.strip().split('\n')[-1] + '\n' + f.read()[-2000:]
+                        continue
+                    results[config] = hash_outputs(root_dir)
+                    times = {name: rec['wall_s'] for name, rec in report['stages'].items()}
+                    times['total'] = report['total']['wall_s']
+                    if config not in best or times['total'] < best[config]['total']:
+                        best[config] = times
+
+        for config in args.configs:
+            row = {'size': size, 'config': config}
+            if config in errors:
+                print(errors[config])
+                row['check'] = 'FAILED'
+                failed = True
+                rows.append(row)
+                continue
+            result = results[config]
+            row.update({name + '_s': round(t, 3) for name, t in best[config].items()})
+            bad = []
+            if config == 'cached' and 'nearest' in results and 'mapping' in best[config]:
+                bad.append('no cache hit')
+            if SAME_AS.get(config) in results:
+                other = results[SAME_AS[config]]
+                bad += ['!=' + SAME_AS[config] + ':' + name for name in compare(other, result) if name in other]
+            ref = reference.get(str(size), {}).get(config)
+            if args.update_reference:
+                reference.setdefault(str(size), {})[config] = result
+                status = 'stored'
+            elif ref is not None:
+                bad += compare(result, ref)
+                status = 'ok'
+            else:
+                status = 'no reference'
+            row['check'] = 'DIFF ' + ','.join(bad) if bad else status
+            failed = failed or bool(bad)
+            rows.append(row)
+            print(pd.DataFrame([row]).to_string(index=False))
+
+    print()
+    print(pd.DataFrame(rows).to_string(index=False))
+    if args.update_reference:
+        with open(REFERENCE, 'w') as f:
+            json.dump(reference, f, indent=1, sort_keys=True)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=1)
+    if failed:
+        sys.exit(1)
@@ -2,15 +2,20 @@ from argparse import ArgumentParser, RawDescriptionHelpFormatter
 import csv
 import datetime as dt
 import os
-from glob import glob
+from discovery_index import load_index, save_index, scan, index_files, index_glob, WORKERS
+from stage_tables import TABLE_FORMATS, table_path
 
 """
 create the help message
 """
 
 __description__ = '''
-For voxel mapping job file
+For voxel mapping job file(s), one per recon
 
+The input and output directories of all recons are listed once into a
+discovery index (see discovery_index.py) and every check is a lookup in it.
+The index is saved and updated incrementally, only directories that changed
+since the last run are listed again.
 '''
 
 parser = ArgumentParser(formatter_class=RawDescriptionHelpFormatter,
@@ -19,13 +24,33 @@ parser = ArgumentParser(formatter_class=RawDescriptionHelpFormatter,
 """
 Output argument
 """
-_help = 'Recon type'
+_help = 'Recon type(s), all checked in one pass'
 parser.add_argument('-recon', '--recon',
                     dest='recon',
                     metavar='recon',
+                    nargs='+',
                     help=_help,
                     required=True)
 
+_help = 'Discovery index file'
+parser.add_argument('--index',
+                    dest='index',
+                    default='/SAN/medic/insight46/jobs/long_suvr_voxel_mapping_index.json',
+                    help=_help)
+
+_help = 'List every directory again instead of reusing unchanged ones'
+parser.add_argument('--rescan',
+                    dest='rescan',
+                    action='store_true',
+                    help=_help)
+
+_help = 'Number of directories listed at the same time'
+parser.add_argument('--workers',
+                    dest='workers',
+                    type=int,
+                    default=WORKERS,
+                    help=_help)
+
 #default_parser_argument(parser)
 
 """
@@ -37,10 +62,48 @@ data_root='/SAN/medic/insight46/midpoint_test'
 #data_root==insight_root when testing is finished
 insight_root='/SAN/medic/insight46/'
 
+#static PET recon of each recon type: directory under insight_root and file name
+#after <subject_label>_ses-<session>_
+RECON_PET = {
+    'console': (['source_bids'], 'pet', 'acq-console-static-50-60_rec-ac_run-1.nii.gz'),
+    'pct': (['source_bids'], 'pet', 'acq-pct-static-50-60_rec-ac_run-1.nii.gz'),
+    'nipet-ute': (['analysis', 'static-pet'], 'PET', 'desc-static-50-60-ute-niftypet-itr4.nii.gz'),
+    'nipet-pct': (['analysis', 'static-pet'], 'PET', 'desc-static-50-60-pct-niftypet-itr4.nii.gz'),
+}
+
+for recon in args.recon:
+    if recon not in RECON_PET:
+        print('invalid recon type')
+        exit(1)
+
+#every directory the checks below look in, relative to insight_root
+scan_patterns={'analysis/gif/sub-*/ses-midpoint/anat',
+               'analysis/midpoint/sub-*/ses-midpoint/xfm',
+               'analysis/drc_brain/sub-*/ses-*/anat'}
+for recon in args.recon:
+    pet_root, pet_dir, _ = RECON_PET[recon]
+    scan_patterns.add('/'.join(pet_root)+'/sub-*/ses-*/'+pet_dir)
+    scan_patterns.add('analysis/suvr-'+recon+'-gif-cereb/sub-*/ses-*/xfm')
+    scan_patterns.add('analysis/longitudinal_pet_voxel_mapping_'+recon+'/sub-*/ses-midpoint/pet')
+
+index=scan(insight_root.rstrip('/'), scan_patterns,
+           None if args.rescan else load_index(args.index), args.workers)
+save_index(index, args.index)
+indexed=index_files(index)
+print('discovery index: '+str(len(indexed))+' files, '+str(index['stats']['listed'])+' directories listed, '+
+      str(index['stats']['reused'])+' unchanged, '+str(index['stats']['seconds'])+'s')
+
+def exists(path):
+    return os.path.normpath(path) in indexed
+
+def table_exists(csv_path):
+    #uptake table written in any --table_format (the csv is optional with npz/parquet)
+    return any(exists(table_path(csv_path, fmt)) for fmt in TABLE_FORMATS)
+
 #get all midpoint GIF, won't count any that haven't been run
-sessions_to_submit=[]
+sessions_to_submit={recon: [] for recon in args.recon}
 
-gif=os.path.join(insight_root,'analysis','gif','sub-*','ses-midpoint','anat','*midpoint_labels.nii.gz')
+gif=os.path.join(insight_root.rstrip('/'),'analysis','gif','sub-*','ses-midpoint','anat','*midpoint_labels.nii.gz')
 
 '''
 WHAT WE NEED:
@@ -54,96 +117,55 @@ WHAT WE NEED:
 8. baseline drc brain mask for cleaning parcellation, could do this a) at midpoint with followup mask too b) after resampling to baseline or c) both
 9. followup drc brain mask for cleaning parcellation, could do this a) at midpoint with baseline  mask too b) after resampling to baseline or c) both
 '''
-#For each session: check input requirments and if already completed
-for gif_par_midpoint in glob(gif):
+#For each session: check input requirments and if already completed, for every recon
+for gif_par_midpoint in index_glob(index, gif):
     
     gif_base=os.path.basename(gif_par_midpoint)
     subject_label=gif_base.split('_')[0]
     subject_id=subject_label.split('-')[1]
     print('Subject: ' + subject_id)
 
-    #check if done already
-    petcsv_cereb = os.path.join(insight_root,'analysis','longitudinal_pet_voxel_mapping_'+args.recon,subject_label,'ses-midpoint','pet',subject_label+'_ses-midpoint_long_cereb_pet_uptake.csv')
-    petcsv_gmcereb = os.path.join(insight_root,'analysis','longitudinal_pet_voxel_mapping_'+args.recon,subject_label,'ses-midpoint','pet',subject_label+'_ses-midpoint_long_gm-cereb-clean_pet_uptake.csv')
-    if glob(petcsv_cereb) and glob(petcsv_gmcereb):
-        print('analysis complete for '+args.recon+' cereb and gm-cereb-clean reference')
-        continue
-    else:
-        mid_t1 = os.path.join(insight_root,'analysis','gif',subject_label,'ses-midpoint','anat',subject_label+'_ses-midpoint_T1w_run-1_desc-gradwarp_spm-midpoint_bias_corrected.nii.gz')
-    
-        if args.recon == 'console':
-            bl_recon=os.path.join(insight_root,'source_bids',subject_label,
-                                  'ses-baseline','pet',subject_label+'_ses-baseline_acq-console-static-50-60_rec-ac_run-1.nii.gz')
-            fu_recon=os.path.join(insight_root,'source_bids',subject_label,
-                                  'ses-followup','pet',subject_label+'_ses-followup_acq-console-static-50-60_rec-ac_run-1.nii.gz')
-        elif args.recon == 'pct':
-            bl_recon=os.path.join(insight_root,'source_bids',subject_label,
-                              'ses-baseline','pet',subject_label+'_ses-baseline_acq-pct-static-50-60_rec-ac_run-1.nii.gz')
-            fu_recon=os.path.join(insight_root,'source_bids',subject_label,
-                                  'ses-followup','pet',subject_label+'_ses-followup_acq-pct-static-50-60_rec-ac_run-1.nii.gz')
-        elif args.recon == 'nipet-ute':
-            bl_recon=os.path.join(insight_root,'analysis','static-pet',subject_label,
-                                  'ses-baseline','PET',subject_label + '_ses-baseline_desc-static-50-60-ute-niftypet-itr4.nii.gz')
-            fu_recon=os.path.join(insight_root,'analysis','static-pet',subject_label,
-                                  'ses-followup','PET',subject_label + '_ses-followup_desc-static-50-60-ute-niftypet-itr4.nii.gz')
-        elif args.recon == 'nipet-pct':
-            bl_recon=os.path.join(insight_root,'analysis','static-pet',subject_label,
-                                  'ses-baseline','PET',subject_label + '_ses-baseline_desc-static-50-60-pct-niftypet-itr4.nii.gz')
-            fu_recon=os.path.join(insight_root,'analysis','static-pet',subject_label,
-                                  'ses-followup','PET',subject_label + '_ses-followup_desc-static-50-60-pct-niftypet-itr4.nii.gz')
-        else:
-            print('invalid recon type')
-            exit(1)
-    
-
-        bl_t1_to_pet_tx=os.path.join(insight_root,'analysis','suvr-'+args.recon+'-gif-cereb',subject_label,'ses-baseline','xfm',subject_label+'_ses-baseline_from-T1w_to-PET_mode-image_xfm.txt')
-        fu_t1_to_pet_tx=os.path.join(insight_root,'analysis','suvr-'+args.recon+'-gif-cereb',subject_label,'ses-followup','xfm',subject_label+'_ses-followup_from-T1w_to-PET_mode-image_xfm.txt')
-        bl_t1_to_mid_def=os.path.join(insight_root,'analysis','midpoint',subject_label,'ses-midpoint','xfm','y_'+subject_label+'_ses-baseline_T1w_run-1_desc-gradwarp_spm-midpoint.nii.gz')
-        fu_t1_to_mid_def=os.path.join(insight_root,'analysis','midpoint',subject_label,'ses-midpoint','xfm','y_'+subject_label+'_ses-followup_T1w_run-1_desc-gradwarp_spm-midpoint.nii.gz')
-        bl_brain_mask=os.path.join(insight_root,'analysis','drc_brain',subject_label,'ses-baseline','anat',subject_label+'_ses-baseline_T1w_run-1_space-orig_desc-drc-brain-mask.nii.gz')
-        fu_brain_mask=os.path.join(insight_root,'analysis','drc_brain',subject_label,'ses-followup','anat',subject_label+'_ses-followup_T1w_run-1_space-orig_desc-drc-brain-mask.nii.gz')
+    #recon independent inputs
+    mid_t1 = os.path.join(insight_root,'analysis','gif',subject_label,'ses-midpoint','anat',subject_label+'_ses-midpoint_T1w_run-1_desc-gradwarp_spm-midpoint_bias_corrected.nii.gz')
+    bl_t1_to_mid_def=os.path.join(insight_root,'analysis','midpoint',subject_label,'ses-midpoint','xfm','y_'+subject_label+'_ses-baseline_T1w_run-1_desc-gradwarp_spm-midpoint.nii.gz')
+    fu_t1_to_mid_def=os.path.join(insight_root,'analysis','midpoint',subject_label,'ses-midpoint','xfm','y_'+subject_label+'_ses-followup_T1w_run-1_desc-gradwarp_spm-midpoint.nii.gz')
+    bl_brain_mask=os.path.join(insight_root,'analysis','drc_brain',subject_label,'ses-baseline','anat',subject_label+'_ses-baseline_T1w_run-1_space-orig_desc-drc-brain-mask.nii.gz')
+    fu_brain_mask=os.path.join(insight_root,'analysis','drc_brain',subject_label,'ses-followup','anat',subject_label+'_ses-followup_T1w_run-1_space-orig_desc-drc-brain-mask.nii.gz')
+
+    for recon in args.recon:
+        #check if done already
+        petcsv_cereb = os.path.join(insight_root,'analysis','longitudinal_pet_voxel_mapping_'+recon,subject_label,'ses-midpoint','pet',subject_label+'_ses-midpoint_long_cereb_pet_uptake.csv')
+        petcsv_gmcereb = os.path.join(insight_root,'analysis','longitudinal_pet_voxel_mapping_'+recon,subject_label,'ses-midpoint','pet',subject_label+'_ses-midpoint_long_gm-cereb-clean_pet_uptake.csv')
+        if table_exists(petcsv_cereb) and table_exists(petcsv_gmcereb):
+            print('analysis complete for '+recon+' cereb and gm-cereb-clean reference')
+            continue
+
+        pet_root, pet_dir, pet_name = RECON_PET[recon]
+        bl_recon=os.path.join(insight_root,*pet_root,subject_label,
+                              'ses-baseline',pet_dir,subject_label+'_ses-baseline_'+pet_name)
+        fu_recon=os.path.join(insight_root,*pet_root,subject_label,
+                              'ses-followup',pet_dir,subject_label+'_ses-followup_'+pet_name)
+
+        bl_t1_to_pet_tx=os.path.join(insight_root,'analysis','suvr-'+recon+'-gif-cereb',subject_label,'ses-baseline','xfm',subject_label+'_ses-baseline_from-T1w_to-PET_mode-image_xfm.txt')
+        fu_t1_to_pet_tx=os.path.join(insight_root,'analysis','suvr-'+recon+'-gif-cereb',subject_label,'ses-followup','xfm',subject_label+'_ses-followup_from-T1w_to-PET_mode-image_xfm.txt')
 
         data_missing=False
-    
-        if not os.path.exists(mid_t1):
-            data_missing=True
-            print('Midpoint T1 missing')
-
-        if not os.path.exists(bl_recon):
-            data_missing=True
-            print('baseline PET RECON missing')
-
-        if not os.path.exists(fu_recon):
-            data_missing=True
-            print('followup PET RECON missing')
-
-        if not os.path.exists(bl_t1_to_pet_tx):
-            data_missing=True
-            print('bl_t1_to_pet_tx missing')
-
-        if not os.path.exists(fu_t1_to_pet_tx):
-            data_missing=True
-            print('fu_t1_to_pet_tx missing')
-
-        if not os.path.exists(bl_t1_to_mid_def):
-            data_missing=True
-            print('bl_t1_to_mid_def missing')
-
-        if not os.path.exists(fu_t1_to_mid_def):
-            data_missing=True
-            print('fu_t1_to_mid_def missing')
-
-        if not os.path.exists(bl_brain_mask):
-            data_missing=True
-            print('bl_brain_mask missing')
-
-        if not os.path.exists(fu_brain_mask):
-            data_missing=True
-            print('fu_brain_mask missing')
+        for name, path in (('Midpoint T1', mid_t1),
+                           ('baseline PET RECON', bl_recon),
+                           ('followup PET RECON', fu_recon),
+                           ('bl_t1_to_pet_tx', bl_t1_to_pet_tx),
+                           ('fu_t1_to_pet_tx', fu_t1_to_pet_tx),
+                           ('bl_t1_to_mid_def', bl_t1_to_mid_def),
+                           ('fu_t1_to_mid_def', fu_t1_to_mid_def),
+                           ('bl_brain_mask', bl_brain_mask),
+                           ('fu_brain_mask', fu_brain_mask)):
+            if not exists(path):
+                data_missing=True
+                print(recon+' '+name+' missing')
 
         if not data_missing:
             session_details={'subject_label': subject_id,
-                             'recon': args.recon,
+                             'recon': recon,
                              'bl_t1_to_pet_tx': bl_t1_to_pet_tx,
                              'fu_t1_to_pet_tx': fu_t1_to_pet_tx,
                              'bl_t1_to_mid_def': bl_t1_to_mid_def,
@@ -155,22 +177,26 @@ for gif_par_midpoint in glob(gif):
                              'bl_brain_mask': bl_brain_mask,
                              'fu_brain_mask': fu_brain_mask
             }
-            sessions_to_submit.append(session_details)
-            print('Adding ' + subject_id + ' data to process')
+            sessions_to_submit[recon].append(session_details)
+            print('Adding ' + subject_id + ' ' + recon + ' data to process')
         else:
-            print('Unable to submit')
+            print('Unable to submit '+recon)
             print('Some data missing')
 
-if sessions_to_submit:
-    today=dt.datetime.now()
-    out_csv='/SAN/medic/insight46/jobs/long_suvr_voxel_mapping_'+args.recon+'_submit_list_' + \
+today=dt.datetime.now()
+for recon in args.recon:
+    if not sessions_to_submit[recon]:
+        print(recon+': nothing to submit')
+        continue
+    out_csv='/SAN/medic/insight46/jobs/long_suvr_voxel_mapping_'+recon+'_submit_list_' + \
         today.strftime('%Y%m%d_%H%M%S') + '.csv'
-    with open(out_csv, 'wb') as csvfile:
+    with open(out_csv, 'w', newline='') as csvfile:
         fieldnames=['subject_label','recon','bl_t1_to_pet_tx','fu_t1_to_pet_tx',
                     'bl_t1_to_mid_def','fu_t1_to_mid_def','gif_midpoint',
                     'bl_pet_recon','fu_pet_recon','t1_midpoint','bl_brain_mask','fu_brain_mask']
         writer = csv.DictWriter(csvfile, fieldnames=fieldnames,
                                 lineterminator=os.linesep)
         writer.writeheader()
-        for i in sessions_to_submit:
+        for i in sessions_to_submit[recon]:
             writer.writerow(i)
+    print(recon+': '+str(len(sessions_to_submit[recon]))+' subjects, job file written to: '+out_csv)
@@ -2,109 +2,89 @@
 This script's job is to identify all data where MIDPOINT REGISTRATION is needed
 1. CHECK IF DONE (QUERY analysis/midpoint/) to see if midpoint T1 images created using: SPM12, ANTS and NIFTY_REG exist.
 2. CHECK IF PREREQ IS THERE: T1 baseline and T1 followup
-3. ADD TO LIST, remove duplicates and print
+3. ADD TO LIST and print
+
+XNAT session lists are cached on disk (see xnat_catalogue.py), daily polling
+only revalidates them. --xnat_host and --anonymous point it at a local stub XNAT.
 '''
+import argparse
 import requests
 import csv
 import datetime as dt
 import os
-from utils import refresh_cookies,get_credentials
+from xnat_catalogue import xnat_session,experiments,pair_visits,TTL
+
+parser = argparse.ArgumentParser(description=__doc__,
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('--xnat_host',type=str,
+                    default='https://nimg1946.cs.ucl.ac.uk',
+                    help='XNAT server')
+parser.add_argument('--anonymous',action='store_true',
+                    help='no login, e.g. for a local stub XNAT')
+parser.add_argument('--cache_dir',type=str,
+                    default='/SAN/medic/insight46/jobs/xnat_cache',
+                    help='XNAT response cache')
+parser.add_argument('--ttl',type=float,default=TTL,
+                    help='seconds a cached XNAT response is used without revalidating it, 0 always revalidates')
+parser.add_argument('--root_dir', type=str,
+                    default='/SAN/medic/insight46',
+                    help='Root directory')
+parser.add_argument('--jobs_dir', type=str,
+                    default='/SAN/medic/insight46/jobs',
+                    help='where the job file is written')
+args=parser.parse_args()
 
 requests.packages.urllib3.disable_warnings()
-xnat_host='https://nimg1946.cs.ucl.ac.uk'
-username,login,pw=get_credentials(xnat_host,
-                                  os.path.expanduser('~/.daxnetrc'))
-headers=refresh_cookies(xnat_host,username,pw,None)
-data_root='/SAN/medic/insight46'
-
-actual_list=[]
-
-#Get all MR sessions
-url_sessions=xnat_host+'/REST/experiments?' + \
-    'xsiType=xnat:mrSessionData&project=1946'
-r=requests.get(url_sessions,headers=headers)
-session_list=r.json()
-
-for session in sorted(session_list['ResultSet']['Result'],
-                      key=lambda k: k['subject_label']):
-    #print(session)
-    sesdict = {
-        "subject_label": session['subject_label'],
-        "label": session['label']
-    }
-    actual_list.append(sesdict)
-
-#now add PETMR sessions
-url_sessions=xnat_host+'/REST/experiments?' + \
-    'xsiType=xnat:petmrSessionData&project=1946'
-r=requests.get(url_sessions,headers=headers)
-session_list=r.json()
-
-for session in sorted(session_list['ResultSet']['Result'],
-                      key=lambda k: k['subject_label']):
-    sesdict = {
-        "subject_label": session['subject_label'],
-        "label": session['label']
-    }
-    actual_list.append(sesdict)
-
-num_sessions = 0
+xnat_host=args.xnat_host
+if args.anonymous:
+    headers=None
+else:
+    from utils import refresh_cookies,get_credentials
+    username,login,pw=get_credentials(xnat_host,
+                                      os.path.expanduser('~/.daxnetrc'))
+    headers=refresh_cookies(xnat_host,username,pw,None)
+data_root=args.root_dir
+session=xnat_session(headers)
+
+#Get all MR sessions, then PETMR sessions
+actual_list=experiments(session,xnat_host,'1946','xnat:mrSessionData',args.cache_dir,args.ttl)
+actual_list+=experiments(session,xnat_host,'1946','xnat:petmrSessionData',args.cache_dir,args.ttl)
+print(str(len(actual_list)) + ' sessions')
+
+#baseline and followup session of each subject, the first listed (MR before PETMR) of each visit
+visits=pair_visits(actual_list)
+
 sessions_to_submit=[]
 #methods=['spm12','ants','nifty-reg']
 #only running SPM for now
 methods=['spm-midpoint']
 
 
-for session in actual_list:
-    
-    num_sessions += 1
+for subject_id in sorted(visits):
 
     #For each subject, does the midpoint T1 already exist?
-    subject_id=session['subject_label']
-    session_id=session['label']
+    bl_session=visits[subject_id].get('baseline')
+    fu_session=visits[subject_id].get('followup')
     mid_tag='midpoint'
 
-    print 'Subject: ' + subject_id + "   Session: " + session_id
-    visit_id=session_id.split('_')[1]
-    if visit_id=='01':
-        visit_tag='baseline'
-    elif visit_id=='02':
-        visit_tag='followup'
-    else:
-        print('Incorrect session label: ' + visit_id)
+    print('Subject: ' + subject_id + '   Sessions: ' + str(bl_session) + ' ' + str(fu_session))
+    if not bl_session or not fu_session:
+        print(subject_id + ' has no ' + ('baseline' if not bl_session else 'followup') + ' session')
+        continue
 
     for method_tag in methods:
-        
+
         mid_t1_file=os.path.join(data_root,'analysis','midpoint',
                                      'sub-'+subject_id,
                                      'ses-'+mid_tag,'anat',
                                      'sub-'+subject_id + '_ses-' + mid_tag +
                                      '_T1w_run-1_desc-gradwarp_' + method_tag + '.nii.gz')
-        #print(gif_labels_file)
         # First check if midpoint T1 has already been run
         if os.path.exists(mid_t1_file):
             print(method_tag +' midpoint T1 already completed. No action')
         else:
             print(method_tag +' midpoint T1 does not exist, looking for T1 images')
 
-            #IF bl session is 'Nope' then search sessions to submit for matching ID number and set to that, same for missing followup
-            bl_session='Nope'
-            fu_session='Nope'
-
-            if visit_id=='01':
-                bl_session=session_id
-                filt_sess=next(iter(filter(lambda sess: sess['subject_label'] == subject_id and sess['followup_session'] != 'Nope', sessions_to_submit)), None)
-                if filt_sess:
-                    fu_session=filt_sess['followup_session']
-
-            else:
-                fu_session=session_id
-                filt_sess=next(iter(filter(lambda sess: sess['subject_label'] == subject_id and sess['baseline_session'] != 'Nope', sessions_to_submit)), None)
-                if filt_sess:
-                    bl_session=filt_sess['baseline_session']
-            
-            
-
             bl_t1_img=os.path.join(data_root,'analysis','gradwarp','sub-'+subject_id,'ses-baseline','anat','sub-'+subject_id+'_ses-baseline_T1w_run-1_desc-gradwarp.nii.gz')
             fu_t1_img=os.path.join(data_root,'analysis','gradwarp','sub-'+subject_id,'ses-followup','anat','sub-'+subject_id+'_ses-followup_T1w_run-1_desc-gradwarp.nii.gz')
 
@@ -124,18 +104,11 @@ for session in actual_list:
                 print(subject_id + ' both timepoint gradwarp T1 missing')
 
 
-#Remove rows with missing sessions
-sessions_to_submit=iter(filter(lambda sess: sess['baseline_session'] != 'Nope' and sess['followup_session'] != 'Nope', sessions_to_submit))
-#Remove remaining  duplactes (as both timepoint sessions got selected, for each method)
-sessions_to_submit=[dict(tupleized) for tupleized in set(tuple(item.items()) for item in sessions_to_submit)]
-
-sessions_to_submit=sorted(sessions_to_submit,key=lambda k: k['subject_label'])
-
 if sessions_to_submit:
     today=dt.datetime.now()
-    out_csv='/SAN/medic/insight46/jobs/midpoint_submit_list_' + \
-        today.strftime('%Y%m%d_%H%M%S') + '.csv'
-    with open(out_csv, 'wb') as csvfile:
+    out_csv=os.path.join(args.jobs_dir,'midpoint_submit_list_' +
+        today.strftime('%Y%m%d_%H%M%S') + '.csv')
+    with open(out_csv, 'w', newline='') as csvfile:
         fieldnames=['subject_label','baseline_session','followup_session','baseline_t1','followup_t1']
         writer = csv.DictWriter(csvfile, fieldnames=fieldnames,
                                 lineterminator=os.linesep)
@@ -144,6 +117,3 @@ if sessions_to_submit:
             writer.writerow(i)
 
     print('Job file written to: ' + out_csv)
-
-
-
@@ -0,0 +1,79 @@
+'''
+Sparse voxel correspondence file, instead of full-volume NIfTI masks
+
+One compressed npz per subject and reference region holds, for every voxel of
+the midpoint region (row n is voxel number n+1), the midpoint, baseline and
+followup PET voxel coordinates (int16), the uptakes (float32), whether the
+pair was kept by dedup and whether it is an LTS outlier, plus the grid (shape
+and affine) of each image. Any of the label or outlier masks written by
+run_long_suvr_voxel_mapping.py can be rebuilt from it with rasterize.
+
+usage: python correspondence.py <correspondence npz> <midpoint|baseline|followup> <label|outlier> <out.nii.gz>
+'''
+import sys
+import numpy as np
+import nibabel as nib
+
+SPACES = ['midpoint', 'baseline', 'followup']
+KINDS = ['label', 'outlier']
+CORRESPONDENCE_SUFFIX = '_correspondence.npz'
+
+
+def write_correspondence(path, ref_roi, vox_values, mid_vox, bl_vox, fu_vox, outlier_vox, imgs):
+    '''
+    write the correspondence of a region, vox_values as the *_pet_uptake table
+    (voxel number 0 marks voxels dropped by dedup), outlier_vox the LTS outlier
+    voxel numbers, imgs the midpoint, baseline and followup images (for grids)
+    '''
+    nvox = len(mid_vox)
+    outlier = np.zeros(nvox, dtype=bool)
+    outlier[np.asarray(outlier_vox, dtype=int) - 1] = True
+    arrays = {'ref_roi': np.array(ref_roi),
+              'kept': vox_values[:, 0] != 0, 'outlier': outlier,
+              'baseline_uptake': vox_values[:, 1].astype(np.float32),
+              'followup_uptake': vox_values[:, 2].astype(np.float32)}
+    for space, vox, img in zip(SPACES, (mid_vox, bl_vox, fu_vox), imgs):
+        arrays[space + '_ijk'] = vox.astype(np.int16)
+        arrays[space + '_shape'] = np.array(img.shape[:3])
+        arrays[space + '_affine'] = img.affine
+    np.savez_compressed(path, **arrays)
+
+
+def load_correspondence(path):
+    with np.load(path) as npz:
+        return {name: npz[name] for name in npz.files}
+
+
+def rasterize(corr, space, kind='label'):
+    '''
+    label (voxel number, int32) or outlier (uint8) mask of a correspondence
+    (dict or path) in the midpoint, baseline or followup grid, as the masks of
+    run_long_suvr_voxel_mapping.py: the midpoint mask has every region voxel,
+    PET masks the first voxel number mapped to each PET voxel
+    returns a Nifti1Image
+    '''
+    if isinstance(corr, str):
+        corr = load_correspondence(corr)
+    shape = tuple(corr[space + '_shape'])
+    vox = corr[space + '_ijk'].astype(np.intp)
+    numbers = np.arange(1, len(vox) + 1, dtype=np.int32)
+    if space != 'midpoint':
+        #kept pairs inside the volume, the first voxel number wins a PET voxel
+        n = np.flatnonzero(corr['kept'] & np.all((vox >= 0) & (vox < shape), axis=1))
+        _, first = np.unique(np.ravel_multi_index(tuple(vox[n].T), shape), return_index=True)
+        vox = vox[n[first]]
+        numbers = numbers[n[first]]
+    if kind == 'outlier':
+        sel = corr['outlier'][numbers - 1]
+        data = np.zeros(shape, dtype=np.uint8, order='F')
+        data[tuple(vox[sel].T)] = 1
+    else:
+        data = np.zeros(shape, dtype=np.int32, order='F')
+        data[tuple(vox.T)] = numbers
+    return nib.Nifti1Image(data, corr[space + '_affine'])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 5 or sys.argv[2] not in SPACES or sys.argv[3] not in KINDS:
+        sys.exit(__doc__)
+    nib.save(rasterize(sys.argv[1], sys.argv[2], sys.argv[3]), sys.argv[4])
@@ -0,0 +1,139 @@
+'''
+On-disk index of the files the job checkers look for
+
+Instead of a glob and a stat per input per subject on the SAN, the directories
+matching a set of directory patterns (e.g. analysis/gif/sub-*/ses-midpoint/anat)
+are listed once, in parallel threads, and every file's size and mtime is
+recorded. The index is saved as json and updated incrementally: a directory
+whose mtime is unchanged has had no files added, removed or renamed, so its
+listing is reused and only its subdirectories are looked at again.
+Files rewritten in place keep a stale size/mtime until --rescan.
+
+usage: python discovery_index.py <index json> <root> <dir pattern> [...] [--rescan]
+'''
+import fnmatch
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+INDEX_VERSION = 1
+#stat calls on a network file system wait on the server, not the GIL
+WORKERS = 16
+
+
+def load_index(path):
+    #saved index, empty if there is none or it is from another version
+    if path and os.path.exists(path):
+        with open(path) as f:
+            index = json.load(f)
+        if index.get('version') == INDEX_VERSION:
+            return index
+    return {'version': INDEX_VERSION, 'dirs': {}}
+
+
+def save_index(index, path):
+    #atomic, the checkers of different recons may share the index
+    tmp = path + '.tmp' + str(os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp, path)
+
+
+def _list_dir(path, old):
+    '''
+    (path, entry) for a directory: its mtime, files {name: [size, mtime_ns]}
+    and subdirectory names, the old entry is reused if the mtime is unchanged
+    entry is None if the directory does not exist
+    '''
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return path, None
+    if old is not None and old['mtime_ns'] == mtime:
+        return path, dict(old, reused=True)
+    files = {}
+    subdirs = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            #.<name>.tmp<pid> files of stage_files are renamed away while we list
+            if entry.name.startswith('.'):
+                continue
+            try:
+                if entry.is_dir():
+                    subdirs.append(entry.name)
+                else:
+                    st = entry.stat()
+                    files[entry.name] = [st.st_size, st.st_mtime_ns]
+            except OSError:
+                #vanished since the listing, or a dangling symlink
+                continue
+    return path, {'mtime_ns': mtime, 'files': files, 'subdirs': sorted(subdirs)}
+
+
+def scan(root, patterns, index=None, workers=WORKERS):
+    '''
+    list every directory under root matching one of the directory patterns
+    (relative to root, fnmatch per path component) and the directories leading
+    to them, one level at a time with the directories of a level in parallel
+    returns the updated index, with scan counts under 'stats'
+    '''
+    old_dirs = index['dirs'] if index else {}
+    dirs = {}
+    #(directory, remaining pattern components) still to list
+    frontier = {(root, tuple(p.strip('/').split('/'))) for p in patterns}
+    n_listed = n_reused = 0
+    started = time.time()
+    with ThreadPoolExecutor(workers) as executor:
+        while frontier:
+            todo = sorted({path for path, _ in frontier if path not in dirs})
+            for path, entry in executor.map(lambda p: _list_dir(p, old_dirs.get(p)), todo):
+                if entry is None:
+                    continue
+                if entry.pop('reused', False):
+                    n_reused += 1
+                else:
+                    n_listed += 1
+                dirs[path] = entry
+            next_frontier = set()
+            for path, parts in frontier:
+                if not parts or path not in dirs:
+                    continue
+                for name in fnmatch.filter(dirs[path]['subdirs'], parts[0]):
+                    next_frontier.add((os.path.join(path, name), parts[1:]))
+            frontier = next_frontier
+    return {'version': INDEX_VERSION, 'root': root, 'patterns': sorted(patterns), 'dirs': dirs,
+            'stats': {'listed': n_listed, 'reused': n_reused, 'seconds': round(time.time() - started, 2)}}
+
+
+def index_files(index):
+    #{path: (size, mtime_ns)} of every indexed file, for exists lookups
+    return {os.path.join(path, name): tuple(st)
+            for path, entry in index['dirs'].items() for name, st in entry['files'].items()}
+
+
+def index_glob(index, pattern):
+    #indexed files matching pattern (absolute, fnmatch per path component), sorted
+    dir_parts = os.path.dirname(pattern).split('/')
+    name_pattern = os.path.basename(pattern)
+    found = []
+    for path, entry in index['dirs'].items():
+        parts = path.split('/')
+        if len(parts) == len(dir_parts) and all(fnmatch.fnmatchcase(p, q) for p, q in zip(parts, dir_parts)):
+            found += [os.path.join(path, name) for name in fnmatch.filter(entry['files'], name_pattern)]
+    return sorted(found)
+
+
+if __name__ == '__main__':
+    argv = sys.argv[1:]
+    rescan = '--rescan' in argv
+    argv = [a for a in argv if a != '--rescan']
+    if len(argv) < 3:
+        sys.exit(__doc__)
+    index_path, root, patterns = argv[0], argv[1], argv[2:]
+    index = scan(root, patterns, None if rescan else load_index(index_path))
+    save_index(index, index_path)
+    print(str(len(index_files(index))) + ' files in ' + str(len(index['dirs'])) + ' directories, ' +
+          str(index['stats']['listed']) + ' listed, ' + str(index['stats']['reused']) + ' unchanged, ' +
+          str(index['stats']['seconds']) + 's')
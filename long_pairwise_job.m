@@ -1,29 +1,81 @@
-function long_pairwise_job(bl_t1, fu_t1, yrs_dif, spm_dir)
+function long_pairwise_job(bl_t1, fu_t1, yrs_dif, spm_dir, manifest)
+% SPM12 pairwise longitudinal registration
+% single pair:  long_pairwise_job(bl_t1, fu_t1, yrs_dif, spm_dir)
+% batch:        long_pairwise_job({bl_t1 ...}, {fu_t1 ...}, [yrs_dif ...], spm_dir, manifest)
+%               long_pairwise_job(pairs_csv, [], [], spm_dir, manifest)
+% pairs_csv has a header and columns bl_t1,fu_t1,yrs_dif. All pairs run in
+% this MATLAB session, a failing pair is recorded and the next one is run.
+% manifest (csv) gets one line per pair: bl_t1,fu_t1,yrs_dif,status,seconds,message
 addpath(spm_dir);
 % check arguments are specified
 if nargin < 4
     error('T1 raw image must be specified');
 end
+if nargin < 5
+    manifest = '';
+end
+
+% list of pairs
+if ischar(bl_t1) && isempty(fu_t1)
+    fid = fopen(bl_t1);
+    pairs = textscan(fid, '%s %s %f', 'Delimiter', ',', 'HeaderLines', 1);
+    fclose(fid);
+    bl_t1 = pairs{1};
+    fu_t1 = pairs{2};
+    yrs_dif = pairs{3};
+elseif ischar(bl_t1)
+    bl_t1 = {bl_t1};
+    fu_t1 = {fu_t1};
+end
 
 spm_jobman('initcfg');
+spm('defaults', 'PET');
 
-%-----------------------------------------------------------------------
-% Job saved on 20-Jul-2020 10:59:26 by cfg_util (rev $Rev: 6460 $)
-% spm SPM - SPM12 (12.1)
-% cfg_basicio BasicIO - Unknown
-%-----------------------------------------------------------------------
-matlabbatch{1}.spm.tools.longit{1}.pairwise.vols1 = {[bl_t1, ',1']};
-matlabbatch{1}.spm.tools.longit{1}.pairwise.vols2 = {[fu_t1, ',1']};
-matlabbatch{1}.spm.tools.longit{1}.pairwise.tdif = yrs_dif;
-matlabbatch{1}.spm.tools.longit{1}.pairwise.noise = NaN;
-matlabbatch{1}.spm.tools.longit{1}.pairwise.wparam = [0 0 100 25 100];
-matlabbatch{1}.spm.tools.longit{1}.pairwise.bparam = 1000000;
-matlabbatch{1}.spm.tools.longit{1}.pairwise.write_avg = 1;
-matlabbatch{1}.spm.tools.longit{1}.pairwise.write_jac = 1;
-matlabbatch{1}.spm.tools.longit{1}.pairwise.write_div = 1;
-matlabbatch{1}.spm.tools.longit{1}.pairwise.write_def = 1;
+if ~isempty(manifest) && ~exist(manifest, 'file')
+    % run_midpoint.py --batch appends the worklist chunk by chunk to one manifest
+    mfid = fopen(manifest, 'w');
+    fprintf(mfid, 'bl_t1,fu_t1,yrs_dif,status,seconds,message\n');
+    fclose(mfid);
+end
 
-spm('defaults', 'PET');
-spm_jobman('run', matlabbatch);
+n_failed = 0;
+for i = 1:numel(bl_t1)
+    %-----------------------------------------------------------------------
+    % Job saved on 20-Jul-2020 10:59:26 by cfg_util (rev $Rev: 6460 $)
+    % spm SPM - SPM12 (12.1)
+    % cfg_basicio BasicIO - Unknown
+    %-----------------------------------------------------------------------
+    clear matlabbatch;
+    matlabbatch{1}.spm.tools.longit{1}.pairwise.vols1 = {[bl_t1{i}, ',1']};
+    matlabbatch{1}.spm.tools.longit{1}.pairwise.vols2 = {[fu_t1{i}, ',1']};
+    matlabbatch{1}.spm.tools.longit{1}.pairwise.tdif = yrs_dif(i);
+    matlabbatch{1}.spm.tools.longit{1}.pairwise.noise = NaN;
+    matlabbatch{1}.spm.tools.longit{1}.pairwise.wparam = [0 0 100 25 100];
+    matlabbatch{1}.spm.tools.longit{1}.pairwise.bparam = 1000000;
+    matlabbatch{1}.spm.tools.longit{1}.pairwise.write_avg = 1;
+    matlabbatch{1}.spm.tools.longit{1}.pairwise.write_jac = 1;
+    matlabbatch{1}.spm.tools.longit{1}.pairwise.write_div = 1;
+    matlabbatch{1}.spm.tools.longit{1}.pairwise.write_def = 1;
+
+    fprintf('pair %d of %d: %s %s\n', i, numel(bl_t1), bl_t1{i}, fu_t1{i});
+    t0 = tic;
+    try
+        spm_jobman('run', matlabbatch);
+        status = 'ok';
+        message = '';
+    catch err
+        n_failed = n_failed + 1;
+        status = 'failed';
+        message = strrep(strrep(err.message, ',', ';'), sprintf('\n'), ' ');
+        fprintf('pair %d failed: %s\n', i, err.message);
+    end
+    if ~isempty(manifest)
+        % appended as each pair finishes, so it is complete up to a crash
+        mfid = fopen(manifest, 'a');
+        fprintf(mfid, '%s,%s,%g,%s,%.1f,%s\n', bl_t1{i}, fu_t1{i}, yrs_dif(i), ...
+                status, toc(t0), message);
+        fclose(mfid);
+    end
+end
 
-exit;
+exit(n_failed > 0);
@@ -0,0 +1,421 @@
+'''
+Least-Trimmed Squares (LTS) regression, Python version of long_suvr_compute_LTS.R
+based on FAST-LTS algorithm proposed in:
+Rousseeuw, P. J., & Van Driessen, K. (2006). Computing LTS regression for large data sets. Data mining and knowledge discovery, 12(1), 29-45.
+follows robustbase::ltsReg for one predictor with intercept (random elemental
+starts, C-steps with intercept adjustment, consistency factor, reweighting, R2)
+perform twice flipping axes and take values identified in both, avoiding bias
+
+writes the same numeric output files as the R script (no plots), the voxel
+tables (_nonzero, _LTS, _outlier_vox_list) in the format of the input table
+usage: python long_suvr_compute_lts.py <input csv|npz|parquet> <reference region> [n_jobs]
+'''
+import os
+import logging
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from statistics import NormalDist
+import numpy as np
+import pandas as pd
+from stage_tables import TABLE_FORMATS, read_table, write_table
+from stage_report import REPORT_SUFFIX, new_report, stage, write_report
+
+#robustbase::rrcov.control() defaults
+NSAMP = 500
+NMINI = 300
+KMINI = 5
+NBEST = 10
+MAX_CSTEPS = 100
+#random starts are drawn and C-stepped in fixed size chunks, each with its own
+#seed, so results do not depend on the number of workers
+START_CHUNK = 50
+
+_norm = NormalDist()
+log = logging.getLogger(__name__)
+
+
+def h_alpha_n(alpha, n, p=2):
+    #size of the LTS subset, as robustbase::h.alpha.n (p includes intercept)
+    n2 = (n + p + 1) // 2
+    return int(np.floor(2 * n2 - n + 2 * (n - n2) * alpha))
+
+
+def _ols(x, y):
+    #intercept and slope of least squares fit for each row of x, y
+    xm = x.mean(axis=1)
+    ym = y.mean(axis=1)
+    xc = x - xm[:, None]
+    sxx = (xc ** 2).sum(axis=1)
+    sxy = (xc * (y - ym[:, None])).sum(axis=1)
+    slope = np.divide(sxy, sxx, out=np.zeros_like(sxy), where=sxx > 0)
+    return np.column_stack([ym - slope * xm, slope])
+
+
+def _lts_location(r, h):
+    '''
+    exact univariate LTS of each row of r: the contiguous window of h sorted
+    values with the smallest sum of squared deviations
+    returns (location, objective)
+    '''
+    r = np.sort(r, axis=1)
+    #centre for numerical stability of the running sums
+    centre = r[:, r.shape[1] // 2][:, None]
+    r = r - centre
+    zero = np.zeros((r.shape[0], 1))
+    c1 = np.hstack([zero, np.cumsum(r, axis=1)])
+    c2 = np.hstack([zero, np.cumsum(r ** 2, axis=1)])
+    s1 = c1[:, h:] - c1[:, :-h]
+    ss = (c2[:, h:] - c2[:, :-h]) - s1 ** 2 / h
+    rows = np.arange(r.shape[0])
+    j = np.argmin(ss, axis=1)
+    return s1[rows, j] / h + centre[:, 0], ss[rows, j]
+
+
+def _lts_objective_path(v, hs):
+    #univariate LTS objective of v for each h in hs, sharing one sort
+    v = np.sort(v)
+    v = v - v[len(v) // 2]
+    c1 = np.concatenate([[0.0], np.cumsum(v)])
+    c2 = np.concatenate([[0.0], np.cumsum(v ** 2)])
+    return {h: ((c2[h:] - c2[:-h]) - (c1[h:] - c1[:-h]) ** 2 / h).min() for h in hs}
+
+
+def _objective(x, y, coef, h):
+    #sum of the h smallest squared residuals for each row of coef
+    r2 = (y - coef[:, :1] - coef[:, 1:] * x) ** 2
+    return np.partition(r2, h - 1, axis=1)[:, :h].sum(axis=1)
+
+
+def _csteps(x, y, coef, h, nsteps=MAX_CSTEPS):
+    '''
+    concentration steps from each row of coef: least squares on the h
+    smallest squared residuals, then intercept adjustment
+    stops after nsteps or when no objective decreases
+    returns (coef, objective)
+    '''
+    obj = _objective(x, y, coef, h)
+    for _ in range(nsteps):
+        r2 = (y - coef[:, :1] - coef[:, 1:] * x) ** 2
+        idx = np.argpartition(r2, h - 1, axis=1)[:, :h]
+        new_coef = _ols(x[idx], y[idx])
+        new_coef[:, 0] = _lts_location(y - new_coef[:, 1:] * x, h)[0]
+        new_obj = _objective(x, y, new_coef, h)
+        improved = new_obj < obj
+        if not improved.any():
+            break
+        coef = np.where(improved[:, None], new_coef, coef)
+        obj = np.where(improved, new_obj, obj)
+    return coef, obj
+
+
+def _elemental_starts(x, y, nsamp, rng):
+    #lines through nsamp random pairs of points with distinct x
+    n = len(x)
+    i = rng.integers(0, n, size=nsamp)
+    j = rng.integers(0, n, size=nsamp)
+    ok = x[i] != x[j]
+    i, j = i[ok], j[ok]
+    slope = (y[j] - y[i]) / (x[j] - x[i])
+    return np.column_stack([y[i] - slope * x[i], slope])
+
+
+def _consistency(h, n):
+    #consistency factor for the LTS scale of h out of n residuals
+    if h >= n:
+        return 1.0
+    q = _norm.inv_cdf((h + n) / (2.0 * n))
+    return 1.0 / np.sqrt(1.0 - (2.0 * n / h) * q * _norm.pdf(q))
+
+
+def _start_chunk(x, y, h, nstarts, seed):
+    #best candidates from a chunk of random elemental starts, 2 C-steps each
+    rng = np.random.default_rng(seed)
+    starts = _elemental_starts(x, y, nstarts, rng)
+    coef, obj = _csteps(x, y, starts, h, 2)
+    keep = np.argsort(obj)[:NBEST]
+    return coef[keep], obj[keep]
+
+
+def _fit_candidates(x, y, h, nsamp, seed, executor=None):
+    '''
+    NBEST candidate fits from random elemental starts, nested subsets for
+    large n, chunks of starts are spread over executor if given
+    '''
+    n = len(y)
+    perm_seed, start_seed = np.random.SeedSequence(seed).spawn(2)
+    if n >= 2 * NMINI:
+        k = min(KMINI, n // NMINI)
+        merged = np.random.default_rng(perm_seed).permutation(n)[:k * NMINI]
+        subsets = np.split(merged, k)
+        nstarts = nsamp // k
+    else:
+        subsets = [np.arange(n)]
+        nstarts = nsamp
+
+    sizes = [START_CHUNK] * (nstarts // START_CHUNK)
+    if nstarts % START_CHUNK:
+        sizes.append(nstarts % START_CHUNK)
+    tasks = []
+    for s, sub_seed in enumerate(start_seed.spawn(len(subsets))):
+        sub = subsets[s]
+        h_sub = h if len(subsets) == 1 else int(np.ceil(len(sub) * h / n))
+        for size, chunk_seed in zip(sizes, sub_seed.spawn(len(sizes))):
+            tasks.append((s, x[sub], y[sub], h_sub, size, chunk_seed))
+    run_map = executor.map if executor is not None else map
+    results = run_map(_start_chunk, *zip(*[t[1:] for t in tasks]))
+
+    coefs = [[] for _ in subsets]
+    objs = [[] for _ in subsets]
+    for task, (coef, obj) in zip(tasks, results):
+        coefs[task[0]].append(coef)
+        objs[task[0]].append(obj)
+    cands = []
+    for coef, obj in zip(coefs, objs):
+        coef = np.vstack(coef)
+        obj = np.concatenate(obj)
+        cands.append(coef[np.argsort(obj)[:NBEST]])
+    if len(subsets) == 1:
+        return cands[0]
+    h_merged = int(np.ceil(len(merged) * h / n))
+    coef, obj = _csteps(x[merged], y[merged], np.vstack(cands), h_merged, 2)
+    return coef[np.argsort(obj)[:NBEST]]
+
+
+def fast_lts(x, y, alpha, nsamp=NSAMP, seed=0, start=None, sy=None, executor=None):
+    '''
+    LTS regression of y on x with intercept, as robustbase::ltsReg
+    executor: optional concurrent.futures executor for the random starts
+    start: [intercept, slope] to run C-steps from instead of random starts
+    sy: precomputed univariate LTS objective of y for this h (for the R2)
+
+    returns dict with alpha, quan (h), best (sorted 0-based indices of the h
+    subset), raw_coefficients, coefficients (reweighted), raw_scale, scale,
+    raw_weights and rsquared; coefficients are [intercept, slope]
+    '''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(y)
+    h = h_alpha_n(alpha, n)
+    if h >= n:
+        h = n
+        coef = _ols(x[None], y[None])[0]
+    else:
+        if start is not None:
+            cands = np.asarray(start, dtype=float)[None]
+        else:
+            cands = _fit_candidates(x, y, h, nsamp, seed, executor)
+        coef, obj = _csteps(x, y, cands, h)
+        coef = coef[np.argmin(obj)]
+
+    resid = y - coef[0] - coef[1] * x
+    best = np.sort(np.argpartition(resid ** 2, h - 1)[:h]) if h < n else np.arange(n)
+    crit = (resid[best] ** 2).sum()
+
+    raw_scale = np.sqrt(crit / h) * _consistency(h, n)
+    if raw_scale > 0:
+        raw_weights = np.abs(resid / raw_scale) <= _norm.inv_cdf(0.9875)
+    else:
+        raw_weights = resid == 0
+    nw = int(raw_weights.sum())
+    if nw >= 2:
+        rw_coef = _ols(x[None, raw_weights], y[None, raw_weights])[0]
+    else:
+        rw_coef = coef
+    rw_resid = y - rw_coef[0] - rw_coef[1] * x
+    scale = np.sqrt((rw_resid[raw_weights] ** 2).sum() / max(nw - 1, 1)) * _consistency(nw, n)
+
+    #robust R2: LTS objective of the residuals against LTS objective of y
+    if sy is None:
+        sy = _lts_location(y[None], h)[1][0]
+    rsquared = max(0.0, min(1.0, 1.0 - crit / sy)) if sy > 0 else 0.0
+
+    return {'alpha': alpha,
+            'quan': h,
+            'best': best,
+            'crit': crit,
+            'raw_coefficients': coef,
+            'coefficients': rw_coef,
+            'raw_scale': raw_scale,
+            'scale': scale,
+            'raw_weights': raw_weights,
+            'rsquared': rsquared}
+
+
+def lm_rsquared(x, y):
+    #R2 of ordinary least squares fit of y on x with intercept
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    coef = _ols(x[None], y[None])[0]
+    ss_res = ((y - coef[0] - coef[1] * x) ** 2).sum()
+    ss_tot = ((y - y.mean()) ** 2).sum()
+    return 1.0 - ss_res / ss_tot if ss_tot > 0 else 0.0
+
+
+def lts_converge(x, y, nsamp=NSAMP, seed=0, path='refit', executor=None):
+    '''
+    LTS of y on x lowering alpha from 0.99 in steps of 0.01 while R2 increases,
+    as the repeat loop in long_suvr_compute_LTS.R (stops before 0.51)
+    falls back to standard lm (all points in) if it beats LTS at alpha 0.99
+
+    path='refit' runs full FAST-LTS at every alpha like the R script,
+    path='warm' only runs C-steps from the previous alpha's fit and takes the
+    R2 denominators for the whole alpha sequence from one sort of y
+
+    returns dict with lts (bool), alpha, rsq, intercept, slope, n_in, n_out
+    and inlier (bool array)
+    '''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(y)
+    #no line through the points (empty region, one voxel or constant uptake),
+    #every elemental start would be dropped
+    if n < 2 or not np.any(x != x[0]):
+        raise ValueError('LTS needs at least 2 voxels with distinct uptake to regress on, got ' +
+                         str(n) + ' voxel(s)' + (' with constant uptake' if n >= 2 else ''))
+    lm_rsq = lm_rsquared(x, y)
+    #alpha as integer percent to avoid floating point drift
+    pct = 99
+    sy_path = {}
+    if path == 'warm':
+        hs = {pc: h_alpha_n(pc / 100, n) for pc in range(51, 100)}
+        sy_h = _lts_objective_path(y, set(h for h in hs.values() if h < n))
+        sy_path = {pc: sy_h.get(h) for pc, h in hs.items()}
+    fit = fast_lts(x, y, pct / 100, nsamp, seed, sy=sy_path.get(pct), executor=executor)
+    rsq = fit['rsquared']
+
+    if rsq < lm_rsq:
+        coef = _ols(x[None], y[None])[0]
+        return {'lts': False, 'alpha': 1, 'rsq': lm_rsq,
+                'intercept': coef[0], 'slope': coef[1],
+                'n_in': n, 'n_out': 0, 'inlier': np.ones(n, dtype=bool)}
+
+    print('LTS with 1% left out beats standard OTS regression, running convergence')
+    while True:
+        new_pct = pct - 1
+        if path == 'warm':
+            new_fit = fast_lts(x, y, new_pct / 100, start=fit['raw_coefficients'],
+                               sy=sy_path[new_pct])
+        else:
+            new_fit = fast_lts(x, y, new_pct / 100, nsamp, seed, executor=executor)
+        new_rsq = new_fit['rsquared']
+        log.debug('alpha = ' + str(pct / 100))
+        log.debug('new alpha = ' + str(new_pct / 100))
+        log.debug('current r2 = ' + str(rsq))
+        log.debug('new r2 = ' + str(new_rsq))
+        if new_pct == 51 or rsq >= new_rsq:
+            break
+        rsq = new_rsq
+        pct = new_pct
+        fit = new_fit
+
+    inlier = np.zeros(n, dtype=bool)
+    inlier[fit['best']] = True
+    return {'lts': True, 'alpha': pct / 100, 'rsq': rsq,
+            'intercept': fit['coefficients'][0], 'slope': fit['coefficients'][1],
+            'n_in': fit['quan'], 'n_out': n - fit['quan'], 'inlier': inlier}
+
+
+def _uptake_stats(long_df, groups):
+    return long_df.groupby(groups)['uptake'].agg(
+        mean_uptake='mean', sd_uptake='std', median_uptake='median',
+        min_uptake='min', max_uptake='max').reset_index()
+
+
+def compute_lts(filename, ref_roi, nsamp=NSAMP, seed=0, path='refit',
+                n_jobs=1, parallel_directions=False, fmt='csv', export_csv=False, report=None):
+    '''
+    run forward (followup ~ baseline) and backward (baseline ~ followup) LTS
+    on a *_pet_uptake.csv and write the _nonzero, _LTS, _LTS_summary,
+    _LTS_outlier_both_stats, _LTS_outlier_stats and _outlier_vox_list files
+    n_jobs > 1 spreads the random starts over a process pool,
+    parallel_directions runs forward and backward at the same time
+    filename is the csv path, voxel tables are read and written in format fmt
+    (see stage_tables), also as csv if export_csv
+    stages are timed into report (see stage_report) if given
+    returns the wide dataframe with outlier columns
+    '''
+    with stage(report, 'lts_io'):
+        wide_df = read_table(filename, fmt)
+
+        # NON-ZERO FILE
+        #remove voxels not in midpoint PET region and save file
+        wide_df = wide_df[wide_df['voxel_number'] != 0].reset_index(drop=True)
+        write_table(wide_df, filename.replace('.csv', '_nonzero.csv'), fmt, export_csv)
+        nvox = len(wide_df)
+
+        bl = wide_df['baseline_uptake'].to_numpy()
+        fu = wide_df['followup_uptake'].to_numpy()
+
+    with stage(report, 'lts_fit'):
+        executor = ProcessPoolExecutor(n_jobs) if n_jobs > 1 else None
+        try:
+            for name, values in (('baseline', bl), ('followup', fu)):
+                if nvox < 2 or not np.any(values != values[0]):
+                    raise ValueError(ref_roi + ': ' + str(nvox) + ' non-zero voxel(s)' +
+                                     (', constant ' + name + ' uptake' if nvox >= 2 else '') +
+                                     ', no LTS fit possible')
+            if parallel_directions:
+                with ThreadPoolExecutor(2) as directions:
+                    fwd = directions.submit(lts_converge, bl, fu, nsamp, seed, path, executor)
+                    bwd = directions.submit(lts_converge, fu, bl, nsamp, seed, path, executor)
+                    fwd = fwd.result()
+                    bwd = bwd.result()
+            else:
+                fwd = lts_converge(bl, fu, nsamp, seed, path, executor)
+                bwd = lts_converge(fu, bl, nsamp, seed, path, executor)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    # FORWARD LTS
+    if not fwd['lts']:
+        print('Standard LM beats LTS forwards')
+    wide_df['outlier1'] = np.where(fwd['inlier'], 'in', 'out')
+
+    # BACKWARDS LTS
+    if not bwd['lts']:
+        print('Standard LM beats LTS backwards')
+    wide_df['outlier2'] = np.where(bwd['inlier'], 'in', 'out')
+
+    # COMBINE LTS OUTLIERS
+    #exclude voxels that are both backwards and forwards outliers
+    wide_df['outlier_both'] = np.where(fwd['inlier'] & bwd['inlier'], 'in', 'out')
+    out_both = int((wide_df['outlier_both'] == 'out').sum())
+
+    with stage(report, 'lts_io'):
+        summary = pd.DataFrame([
+            {'direction': name, 'ref_roi': ref_roi, 'nvox': nvox, 'lts': res['lts'],
+             'alpha': res['alpha'], 'rsquared': res['rsq'],
+             'intercept': res['intercept'], 'slope': res['slope'],
+             'n_in': res['n_in'], 'n_out': res['n_out'], 'n_out_both': out_both}
+            for name, res in (('forward', fwd), ('backward', bwd))])
+        summary.to_csv(filename.replace('.csv', '_LTS_summary.csv'), index=False)
+
+        # TABLES
+        long_df = wide_df.melt(id_vars=['voxel_number', 'outlier1', 'outlier2', 'outlier_both'],
+                               value_vars=['baseline_uptake', 'followup_uptake'],
+                               var_name='timepoint', value_name='uptake')
+        long_df['timepoint'] = long_df['timepoint'].str.replace('_uptake', '')
+        _uptake_stats(long_df, ['timepoint', 'outlier_both']).to_csv(
+            filename.replace('.csv', '_LTS_outlier_both_stats.csv'), index=False)
+        _uptake_stats(long_df, ['timepoint', 'outlier1', 'outlier2']).to_csv(
+            filename.replace('.csv', '_LTS_outlier_stats.csv'), index=False)
+
+        # OUTPUT FILES
+        write_table(wide_df, filename.replace('.csv', '_LTS.csv'), fmt, export_csv)
+        write_table(wide_df.loc[wide_df['outlier_both'] == 'out', ['voxel_number']],
+                    filename.replace('.csv', '_outlier_vox_list.csv'), fmt, export_csv)
+    return wide_df
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        sys.exit('Two arguments must be supplied (input csv path; reference region)')
+    n_jobs = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    base, ext = os.path.splitext(sys.argv[1])
+    fmt = ext[1:] if ext[1:] in TABLE_FORMATS else 'csv'
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    report = new_report(__file__)
+    compute_lts(base + '.csv', sys.argv[2], n_jobs=n_jobs, parallel_directions=n_jobs > 1, fmt=fmt,
+                report=report)
+    write_report(report, base + '_lts' + REPORT_SUFFIX)
@@ -0,0 +1,216 @@
+'''
+LTS plots, decoupled from the LTS fit
+
+Draws the plots long_suvr_compute_LTS.R used to draw on every run (forward and
+backward baseline/followup plots with the LTS fit, all-voxel and LTS
+histograms) from the LTS outputs already written, so it can run after the
+numeric results, be left off, or be run for a whole cohort at once. The voxel
+pairs are drawn as a hexbin or 2-D density with the outliers on top, or as a
+random subsample scatter, and saved as raster images, so the time and file
+size do not grow with the number of voxels.
+
+usage: python plot_lts.py <*_pet_uptake.csv or dir> [...] [--style hexbin|density|scatter] [--workers 8]
+       directories are searched recursively for *_pet_uptake_LTS tables
+'''
+import argparse
+import glob
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+from stage_tables import TABLE_FORMATS, table_path, read_table
+
+STYLES = ['hexbin', 'density', 'scatter']
+#points drawn at most per scatter / outlier overlay
+MAX_POINTS = 5000
+#histogram bin width (Bq/ml), as the R plots
+BINWIDTH = 200
+PLOT_SUFFIXES = ['_LTS_plot1', '_LTS_plot2', '_allvox_hist', '_LTS_hist']
+COLOURS = {'in': '#56B4E9', 'out': '#E69F00', 'baseline': '#56B4E9', 'followup': '#999999'}
+
+
+def table_format(csv_path):
+    #format the _LTS table of csv_path was written in (npz/parquet if present, else csv)
+    lts_path = csv_path.replace('.csv', '_LTS.csv')
+    for fmt in TABLE_FORMATS:
+        if fmt != 'csv' and os.path.exists(table_path(lts_path, fmt)):
+            return fmt
+    return 'csv'
+
+
+def _fits(csv_path, wide_df, fmt='csv'):
+    '''
+    (intercept, slope, alpha) of the forward and backward LTS fits, from the
+    _LTS_summary (python LTS) or OLS on each direction's inliers (R LTS writes
+    no summary). A summary older than the _nonzero table, which both engines
+    write before fitting, is left over from an earlier python run and ignored
+    '''
+    summary_file = csv_path.replace('.csv', '_LTS_summary.csv')
+    nonzero_file = table_path(csv_path.replace('.csv', '_nonzero.csv'), fmt)
+    if os.path.exists(summary_file) and not (
+            os.path.exists(nonzero_file) and os.path.getmtime(summary_file) < os.path.getmtime(nonzero_file)):
+        summary = pd.read_csv(summary_file).set_index('direction')
+        return {d: (summary.loc[d, 'intercept'], summary.loc[d, 'slope'], summary.loc[d, 'alpha'])
+                for d in ('forward', 'backward')}
+    fits = {}
+    for d, col, x, y in (('forward', 'outlier1', 'baseline_uptake', 'followup_uptake'),
+                         ('backward', 'outlier2', 'followup_uptake', 'baseline_uptake')):
+        inl = wide_df[col] == 'in'
+        slope, intercept = np.polyfit(wide_df.loc[inl, x], wide_df.loc[inl, y], 1)
+        fits[d] = (intercept, slope, round(inl.mean(), 2))
+    return fits
+
+
+def _subsample(n, max_points, rng):
+    #indices of at most max_points of n, sorted
+    if n <= max_points:
+        return np.arange(n)
+    return np.sort(rng.choice(n, max_points, replace=False))
+
+
+def _pairs_plot(ax, x, y, out, style, max_points, rng):
+    if style == 'scatter':
+        idx = _subsample(len(x), max_points, rng)
+        for flag in (False, True):
+            sel = idx[out[idx] == flag]
+            ax.scatter(x[sel], y[sel], s=4, alpha=0.5, linewidths=0,
+                       color=COLOURS['out' if flag else 'in'], label='out' if flag else 'in')
+        return
+    if style == 'hexbin':
+        ax.hexbin(x, y, gridsize=80, bins='log', mincnt=1, cmap='Blues')
+    else:
+        counts, xe, ye = np.histogram2d(x, y, bins=150)
+        ax.pcolormesh(xe, ye, np.log1p(counts.T), cmap='Blues', shading='flat')
+    #outliers on top of the density
+    idx = np.flatnonzero(out)
+    idx = idx[_subsample(len(idx), max_points, rng)]
+    ax.scatter(x[idx], y[idx], s=3, linewidths=0, color=COLOURS['out'], label='out')
+
+
+def plot_lts(csv_path, ref_roi=None, style='hexbin', fmt=None, max_points=MAX_POINTS,
+             plot_format='png', seed=0):
+    '''
+    write the LTS plots of a *_pet_uptake.csv next to it (needs matplotlib),
+    fmt is the table format (see stage_tables), found from the files if None
+    returns the plot paths
+    '''
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    if fmt is None:
+        fmt = table_format(csv_path)
+    wide_df = read_table(csv_path.replace('.csv', '_LTS.csv'), fmt)
+    if ref_roi is None:
+        ref_roi = os.path.basename(csv_path).split('_long_')[-1].replace('_pet_uptake.csv', '')
+    fits = _fits(csv_path, wide_df, fmt)
+    rng = np.random.default_rng(seed)
+    bl = wide_df['baseline_uptake'].to_numpy()
+    fu = wide_df['followup_uptake'].to_numpy()
+    nvox = len(wide_df)
+    paths = [csv_path.replace('.csv', suffix + '.' + plot_format) for suffix in PLOT_SUFFIXES]
+
+    #forward and backward pairs with identity, OLS and LTS lines
+    for path, (title, col, d, x, y, xlabel, ylabel) in zip(paths[:2], (
+            ('Outliers 1', 'outlier1', 'forward', bl, fu, 'Baseline', 'Follow-up'),
+            ('Outliers 2', 'outlier2', 'backward', fu, bl, 'Follow-up', 'Baseline'))):
+        out = (wide_df[col] == 'out').to_numpy()
+        intercept, slope, alpha = fits[d]
+        fig, ax = plt.subplots(figsize=(6.5, 5))
+        _pairs_plot(ax, x, y, out, style, max_points, rng)
+        lims = np.array([min(x.min(), y.min()), max(x.max(), y.max())])
+        ols_slope, ols_intercept = np.polyfit(x, y, 1)
+        ax.plot(lims, lims, ':', color='black', linewidth=1)
+        ax.plot(lims, ols_intercept + ols_slope * lims, color='grey', linewidth=1, label='OLS')
+        ax.plot(lims, intercept + slope * lims, '--', color='black', linewidth=1.5, label='LTS')
+        ax.set_xlim(lims)
+        ax.set_ylim(lims)
+        ax.set_aspect('equal')
+        ax.set_xlabel(xlabel + ' Activity (Bq/ml)')
+        ax.set_ylabel(ylabel + ' Activity (Bq/ml)')
+        ax.set_title(title + '\nRef=' + ref_roi + '; N=' + str(nvox) + '; Out=' + str(int(out.sum())) +
+                     '; In=' + str(int(nvox - out.sum())) + '; alpha=' + str(alpha), fontsize=10)
+        ax.legend(loc='upper left', fontsize=8, markerscale=3)
+        fig.savefig(path, dpi=150, bbox_inches='tight')
+        plt.close(fig)
+
+    #histograms of both time points, all voxels and split by outlier_both
+    bins = np.arange(np.floor(min(bl.min(), fu.min()) / BINWIDTH),
+                     np.ceil(max(bl.max(), fu.max()) / BINWIDTH) + 1) * BINWIDTH
+    out_both = (wide_df['outlier_both'] == 'out').to_numpy()
+    groups = ([('All Voxels', np.ones(nvox, dtype=bool))],
+              [('in', ~out_both), ('out', out_both)])
+    for path, panels in zip(paths[2:], groups):
+        fig, axes = plt.subplots(1, len(panels), figsize=(6.5, 5), sharey=True, squeeze=False)
+        for ax, (name, sel) in zip(axes[0], panels):
+            for tp, values in (('baseline', bl), ('followup', fu)):
+                counts, _ = np.histogram(values[sel], bins)
+                ax.stairs(counts, bins, fill=True, alpha=0.5, color=COLOURS[tp], label=tp)
+            ax.set_title(name, fontsize=9)
+            ax.set_xlabel('Activity (Bq/ml)')
+        axes[0][0].set_ylabel('Count')
+        axes[0][0].legend(fontsize=8)
+        if len(panels) == 1:
+            fig.suptitle('All Voxels\nRef=' + ref_roi + '; N vox=' + str(nvox), fontsize=10)
+        else:
+            fig.suptitle('LTS Histograms\nRef=' + ref_roi + '; N=' + str(nvox) + '; Out=' +
+                         str(int(out_both.sum())) + '; In=' + str(int(nvox - out_both.sum())) +
+                         '; alpha1=' + str(fits['forward'][2]) + '; alpha2=' + str(fits['backward'][2]),
+                         fontsize=10)
+        fig.savefig(path, dpi=150, bbox_inches='tight')
+        plt.close(fig)
+    return paths
+
+
+def find_uptake_tables(paths):
+    #*_pet_uptake.csv paths of the LTS tables in files and directories (searched recursively)
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for fmt in TABLE_FORMATS:
+                for lts in glob.glob(os.path.join(path, '**', '*_pet_uptake_LTS.' + fmt), recursive=True):
+                    found.append(lts[:-len('_LTS.' + fmt)] + '.csv')
+        else:
+            found.append(path)
+    return sorted(set(found))
+
+
+def _plot_one(csv_path, style, max_points, plot_format):
+    #plot_lts for the process pool, returns (csv_path, error)
+    try:
+        plot_lts(csv_path, style=style, max_points=max_points, plot_format=plot_format)
+        return csv_path, None
+    except Exception as e:
+        return csv_path, repr(e)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', type=str, nargs='+',
+                        help='*_pet_uptake.csv files or directories')
+    parser.add_argument('--style', type=str, choices=STYLES, default='hexbin',
+                        help='voxel pairs as hexbin, 2-D density or subsampled scatter')
+    parser.add_argument('--max_points', type=int, default=MAX_POINTS,
+                        help='points drawn at most per scatter or outlier overlay')
+    parser.add_argument('--plot_format', type=str, default='png',
+                        help='image format, e.g. png or pdf (a pdf stays small, points are binned or subsampled)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of tables plotted at the same time')
+    args = parser.parse_args()
+
+    tables = find_uptake_tables(args.paths)
+    print(str(len(tables)) + ' LTS tables to plot on ' + str(args.workers) + ' workers')
+    n_failed = 0
+    with ProcessPoolExecutor(args.workers) as executor:
+        futures = [executor.submit(_plot_one, t, args.style, args.max_points, args.plot_format)
+                   for t in tables]
+        for future in as_completed(futures):
+            csv_path, error = future.result()
+            if error:
+                n_failed += 1
+                print(csv_path + ' failed: ' + error)
+    print(str(len(tables) - n_failed) + ' plotted, ' + str(n_failed) + ' failed')
+    if n_failed:
+        sys.exit(1)
@@ -0,0 +1,120 @@
+'''
+Reference region masks built from the midpoint GIF parcellation
+
+Replaces the fslmaths/seg_maths chain in submit_long_suvr_voxel_mapping.sh and
+the per-label == comparisons in run_long_suvr_voxel_mapping.py. To add a
+reference region add a row to REF_ROI_TABLE.
+'''
+import os
+import numpy as np
+import nibabel as nib
+
+#labels: GIF labels in the region
+#tissue, threshold: keep voxels with GIF seg probability of that tissue (time
+#point) >= threshold, as seg_maths -tp <tissue> -thr <threshold>
+#mask: region is supplied as a mask file (--ref_roi_mask roi=path)
+REF_ROI_TABLE = {
+    #whole cerebellum
+    'cereb': {'labels': [39, 40, 41, 42, 72, 73, 74]},
+    #cerebellar GM (exterior and vermal lobules) cleaned with GM probability
+    'gm-cereb-clean': {'labels': [39, 40, 72, 73, 74], 'tissue': 2, 'threshold': 0.9},
+    #eroded subcortical WM
+    'wm-subcort-gif3': {'mask': True},
+}
+
+
+def needs_mask_file(ref_roi, have_seg=False):
+    #region is read from a --ref_roi_mask file: no labels, or a tissue threshold without the segmentation
+    spec = REF_ROI_TABLE[ref_roi]
+    return 'labels' not in spec or ('tissue' in spec and not have_seg)
+
+
+def roi_mask_files(ref_rois, mask_args, have_seg=False):
+    '''
+    {ref_roi: mask file} for the regions of ref_rois that need one, from
+    --ref_roi_mask entries roi=path, or bare paths matched by position to the
+    regions needing a mask that are not named
+    raises ValueError if a region is left without a mask or a mask is unused
+    '''
+    mask_rois = [r for r in ref_rois if needs_mask_file(r, have_seg)]
+    files = {}
+    positional = []
+    for entry in mask_args or []:
+        roi, sep, path = entry.partition('=')
+        if sep and roi in REF_ROI_TABLE:
+            if roi not in mask_rois:
+                raise ValueError('--ref_roi_mask ' + entry + ': ' + roi + ' is not a requested region needing a mask file')
+            files[roi] = path
+        else:
+            positional.append(entry)
+    unnamed = [r for r in mask_rois if r not in files]
+    if len(positional) != len(unnamed):
+        raise ValueError(str(len(positional)) + ' unnamed --ref_roi_mask file(s) for ' + str(len(unnamed)) +
+                         ' region(s) needing one (' + ', '.join(unnamed) + '), use roi=path (or --mid_seg)')
+    files.update(zip(unnamed, positional))
+    return files
+
+
+def label_index(par_data):
+    #integer label volume from a (float) parcellation, shared by every region
+    return np.rint(par_data).astype(np.int32, order='K')
+
+
+def _keep_order(mask, ref):
+    #keep the memory order of the parcellation, voxel numbering follows it
+    if ref.flags.f_contiguous and not ref.flags.c_contiguous:
+        return np.asfortranarray(mask)
+    return mask
+
+
+def label_set_mask(label_idx, labels):
+    #voxels whose label is in labels, one pass through a lookup table
+    lut = np.zeros(max(int(label_idx.max()), max(labels)) + 1, dtype=bool)
+    lut[labels] = True
+    return _keep_order(lut[np.clip(label_idx, 0, None)], label_idx)
+
+
+def tissue_prob(seg_img, tissue, shape):
+    #one tissue probability volume (time point) of a 4-D/5-D GIF segmentation
+    return np.asanyarray(seg_img.dataobj[..., tissue]).reshape(shape)
+
+
+def build_ref_mask(ref_roi, label_idx, seg_img=None):
+    '''
+    binary (0/1 int8) mask of a REF_ROI_TABLE region with labels, from the
+    integer label volume and optionally the GIF segmentation
+    '''
+    spec = REF_ROI_TABLE[ref_roi]
+    mask = label_set_mask(label_idx, spec['labels'])
+    if 'tissue' in spec:
+        if seg_img is None:
+            raise ValueError(ref_roi + ' needs the GIF segmentation (--mid_seg)')
+        mask &= tissue_prob(seg_img, spec['tissue'], label_idx.shape) >= spec['threshold']
+    return mask.astype(np.int8)
+
+
+def ref_mask_path(anat_dir, subject_label, ref_roi):
+    #cached mask next to the subject outputs, same name the shell scripts used
+    return os.path.join(anat_dir, subject_label + '_ses-midpoint_T1w_run-1_desc-' + ref_roi + '.nii.gz')
+
+
+def cached_ref_mask(ref_roi, label_idx, par_img, cache_path, seg_img=None):
+    '''
+    load ref_roi mask from cache_path if it exists and is newer than the
+    parcellation (and segmentation) files it is built from, otherwise build it
+    and save it there (int, parcellation affine)
+    '''
+    if os.path.exists(cache_path):
+        sources = [par_img.get_filename()]
+        if 'tissue' in REF_ROI_TABLE[ref_roi] and seg_img is not None:
+            sources.append(seg_img.get_filename())
+        mask_mtime = os.path.getmtime(cache_path)
+        if all(os.path.getmtime(src) <= mask_mtime for src in sources if src):
+            print(ref_roi + ' mask already exists: ' + cache_path)
+            return _keep_order(np.asanyarray(nib.load(cache_path).dataobj), label_idx)
+        print(ref_roi + ' mask older than the parcellation or segmentation, rebuilding: ' + cache_path)
+    mask = build_ref_mask(ref_roi, label_idx, seg_img)
+    mask_img = nib.Nifti1Image(mask.astype(np.int32), affine=par_img.affine)
+    nib.save(mask_img, cache_path)
+    print(ref_roi + ' mask saved: ' + cache_path)
+    return mask
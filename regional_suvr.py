@@ -0,0 +1,81 @@
+'''
+Regional longitudinal SUVR of every GIF parcel for run_long_suvr_voxel_mapping.py
+
+All labelled midpoint voxels are mapped to baseline and followup PET in one go
+with the reference regions, uptake is then reduced per label with grouped array
+operations (bincount sums and counts, one sort for the medians) and normalised
+by the LTS-cleaned reference region uptake (outlier voxels removed).
+'''
+import numpy as np
+import pandas as pd
+
+REGIONAL = 'regional'
+
+
+def parcel_voxels(label_idx):
+    '''
+    coordinates (nvox, 3) and labels of every labelled (> 0) voxel of an
+    integer label volume, in memory order as label_roi
+    '''
+    order = 'F' if label_idx.flags.f_contiguous and not label_idx.flags.c_contiguous else 'C'
+    flat_labels = label_idx.ravel(order=order)
+    flat = np.flatnonzero(flat_labels > 0)
+    coords = np.column_stack(np.unravel_index(flat, label_idx.shape, order=order))
+    return coords, flat_labels[flat].astype(np.int32)
+
+
+def in_volume(vox, shape):
+    #rows of vox inside a volume of shape
+    return np.all((vox >= 0) & (vox < np.array(shape[:3])), axis=1)
+
+
+def grouped_stats(labels, values):
+    '''
+    number of voxels, sum, mean and median of values for each label
+    returns (unique labels, dict of arrays in the same order)
+    '''
+    uniq, inv = np.unique(labels, return_inverse=True)
+    inv = inv.reshape(-1)
+    count = np.bincount(inv, minlength=len(uniq))
+    total = np.bincount(inv, weights=values, minlength=len(uniq))
+    #values sorted within each label, the median is the middle one (or two)
+    ordered = values[np.lexsort((values, inv))]
+    start = np.cumsum(count) - count
+    median = (ordered[start + (count - 1) // 2] + ordered[start + count // 2]) / 2
+    return uniq, {'nvox': count, 'sum': total, 'mean': total / count, 'median': median}
+
+
+def cleaned_reference(vox_values, outlier_vox):
+    '''
+    mean baseline and followup uptake of a reference region without the
+    voxels dropped by dedup (voxel number 0) and the LTS outliers
+    '''
+    inlier = vox_values[:, 0] != 0
+    inlier[np.asarray(outlier_vox, dtype=int) - 1] = False
+    return {'nvox': int(inlier.sum()),
+            'baseline': vox_values[inlier, 1].mean(),
+            'followup': vox_values[inlier, 2].mean()}
+
+
+def regional_table(labels, bl_values, fu_values, ref_uptake):
+    '''
+    one row per label and reference region: voxels, baseline and followup
+    mean and median uptake, SUVR at each time point and its change
+    ref_uptake is {ref_roi: cleaned_reference(...)}
+    '''
+    uniq, bl = grouped_stats(labels, bl_values)
+    _, fu = grouped_stats(labels, fu_values)
+    uptake = pd.DataFrame({'label': uniq, 'nvox': bl['nvox'],
+                           'baseline_mean_uptake': bl['mean'], 'baseline_median_uptake': bl['median'],
+                           'followup_mean_uptake': fu['mean'], 'followup_median_uptake': fu['median']})
+    tables = []
+    for ref_roi, ref in ref_uptake.items():
+        df = uptake.copy()
+        df.insert(0, 'ref_roi', ref_roi)
+        df['ref_nvox'] = ref['nvox']
+        df['baseline_suvr'] = df['baseline_mean_uptake'] / ref['baseline']
+        df['followup_suvr'] = df['followup_mean_uptake'] / ref['followup']
+        df['suvr_change'] = df['followup_suvr'] - df['baseline_suvr']
+        df['suvr_change_pct'] = 100 * df['suvr_change'] / df['baseline_suvr']
+        tables.append(df)
+    return pd.concat(tables, ignore_index=True)
@@ -1,13 +1,24 @@
 import argparse
 import numpy as np
 #import matplotlib.pyplot as plt
-import pandas as pd
 np.set_printoptions(precision=4, suppress=True)
 import numpy.linalg as npl
 import nibabel as nib
 import os
 from glob import glob
 import subprocess
+import logging
+from voxel_mapping import label_roi,map_roi_voxels,dedup_voxel_pairs,outlier_masks, \
+    load_data,gather_values,peak_rss_mb,map_roi_points,trilinear_values,label_nearest, \
+    load_affine_txt,pet_mapping_affine,compose_def_affine,label_coords,pet_geometry,MAPPING_VERSION
+from long_suvr_compute_lts import compute_lts
+from stage_tables import TABLE_FORMATS,uptake_table,write_table,read_table
+from stage_cache import input_digests,cache_key,cache_get,cache_put,cache_evict,cache_claim,cache_release
+from stage_report import new_report,stage,write_report,print_report,REPORT_SUFFIX
+from ref_masks import REF_ROI_TABLE,label_index,cached_ref_mask,ref_mask_path,roi_mask_files
+from regional_suvr import REGIONAL,parcel_voxels,in_volume,cleaned_reference,regional_table
+from correspondence import write_correspondence,CORRESPONDENCE_SUFFIX
+from plot_lts import STYLES as PLOT_STYLES,plot_lts
 
 parser = argparse.ArgumentParser(description='Voxel Mapping')
 parser.add_argument('--subject',type=str,
@@ -16,25 +27,78 @@ parser.add_argument('--mid_to_bl',type=str,
                     help='deformation field from mid T1 -> baseline PET')
 parser.add_argument('--mid_to_fu',type=str,
                     help='deformation field from mid T1 -> followup PET')
+parser.add_argument('--bl_def',type=str,
+                    help='SPM deformation mid T1 -> baseline T1, with --bl_aff instead of --mid_to_bl')
+parser.add_argument('--fu_def',type=str,
+                    help='SPM deformation mid T1 -> followup T1, with --fu_aff instead of --mid_to_fu')
+parser.add_argument('--bl_aff',type=str,
+                    help='baseline T1 -> PET rigid transform (NiftyReg affine .txt)')
+parser.add_argument('--fu_aff',type=str,
+                    help='followup T1 -> PET rigid transform (NiftyReg affine .txt)')
+parser.add_argument('--save_def',action='store_true',
+                    help='with --bl_def/--fu_def also write the composed MID-to-PET deformation fields')
 parser.add_argument('--mid_par',type=str,
                     help='cleaned midpoint GIF parcelltion')
 parser.add_argument('--bl_pet',type=str,
                     help='baseline PET')
 parser.add_argument('--fu_pet',type=str,
                     help='followup PET')
-parser.add_argument('--ref_roi',type=str,
-                    help='reference region')
-parser.add_argument('--ref_roi_mask',type=str,
-                    help='reference region mask')
+parser.add_argument('--ref_roi',type=str,nargs='+',
+                    help='reference region(s), several are mapped in one pass')
+parser.add_argument('--ref_roi_mask',type=str,nargs='+',
+                    help='reference region mask(s) for regions not built from the parcellation, as roi=path, or paths in --ref_roi order of the regions needing one')
+parser.add_argument('--mid_seg',type=str,
+                    help='midpoint GIF segmentation (tissue probabilities), for gm-cereb-clean')
+parser.add_argument('--regional',action='store_true',
+                    help='also map every labelled parcel of --mid_par in the same pass and write regional SUVR change, normalised by the LTS-cleaned reference region(s)')
 parser.add_argument('--alpha',type=float,
                     help='alpha value for LTS regression, needs to be between 0.5 and 1. Relates to proportion of voxels included')
+parser.add_argument('--lts_engine',type=str,
+                    choices=['python','R'],default='python',
+                    help='run LTS in process (python) or with long_suvr_compute_LTS.R')
+parser.add_argument('--plots',type=str,
+                    choices=['off']+PLOT_STYLES,default='off',
+                    help='LTS plots after the numeric outputs (needs matplotlib): off, hexbin, 2-D density or subsampled scatter, plot_lts.py also plots a whole cohort afterwards')
+parser.add_argument('--lts_path',type=str,
+                    choices=['refit','warm'],default='refit',
+                    help='python LTS alpha search: full refit at each alpha, or warm start from the previous alpha')
+parser.add_argument('--lts_jobs',type=int,default=1,
+                    help='number of worker processes for the python LTS random starts')
+parser.add_argument('--lts_parallel',action='store_true',
+                    help='run forward and backward python LTS at the same time')
+parser.add_argument('--load_mode',type=str,
+                    choices=['full','lean'],default='full',
+                    help='full: float64 get_fdata of every image, lean: native dtypes, read only the roi bounding box')
+parser.add_argument('--sampling',type=str,
+                    choices=['nearest','trilinear'],default='nearest',
+                    help='PET sampling: nearest voxel with first-come dedup, or trilinear so every roi voxel gets a value')
+parser.add_argument('--table_format',type=str,
+                    choices=TABLE_FORMATS,default='csv',
+                    help='format of the voxel tables passed between stages, npz/parquet include voxel coordinates')
+parser.add_argument('--export_csv',action='store_true',
+                    help='also write the voxel tables as csv when --table_format is npz or parquet')
+parser.add_argument('--mask_output',type=str,
+                    choices=['nifti','sparse','both'],default='nifti',
+                    help='full-volume NIfTI label and outlier masks, a sparse voxel correspondence npz (masks can be rebuilt with correspondence.py), or both')
+parser.add_argument('--cache',type=str,
+                    choices=['on','off','refresh'],default='on',
+                    help='stage cache of the mapped voxel pairs: reuse when inputs are unchanged, off, or refresh (recompute and overwrite)')
+parser.add_argument('--cache_dir',type=str,
+                    help='stage cache directory, default <root_dir>/stage_cache')
+parser.add_argument('--cache_max_gb',type=float,default=50,
+                    help='least recently used cache entries are evicted above this size')
+parser.add_argument('--debug',action='store_true',
+                    help='debug logging, e.g. every LTS alpha step')
 parser.add_argument('--root_dir', type=str,
                     default='/SAN/medic/insight46',
                     help='Root directory')
 
 args=parser.parse_args()
+#force: replace the handler of a previous subject run in the same batch worker (stderr is its log)
+logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO, format='%(message)s', force=True)
 
-if not  args.mid_to_bl or not args.mid_to_fu or not args.mid_par \
+if not (args.mid_to_bl or (args.bl_def and args.bl_aff)) \
+   or not (args.mid_to_fu or (args.fu_def and args.fu_aff)) or not args.mid_par \
    or not args.bl_pet or not args.fu_pet or not args.ref_roi:
     parser.error('argument missing')
 else:
@@ -50,215 +114,361 @@ else:
         alpha=str(0.75)
         
     subject_label='sub-' + args.subject
+    #wall/cpu time, peak RSS and IO per stage, written to ses-midpoint/pet at the end
+    report = new_report(__file__, subject_label)
         
     bl_out_anat_dir=os.path.join(data_root,subject_label,'ses-baseline','anat')
     fu_out_anat_dir=os.path.join(data_root,subject_label,'ses-followup','anat')
     mid_out_anat_dir=os.path.join(data_root,subject_label,'ses-midpoint','anat')
     mid_out_pet_dir=os.path.join(data_root,subject_label,'ses-midpoint','pet')
 
-    
-    csv_out_path=os.path.join(mid_out_pet_dir,subject_label+'_ses-midpoint_long_'+args.ref_roi+'_pet_uptake.csv')
-    #if glob(csv_out_path):
-    #    print('outfile already exists, exit, skip to')
-    #    exit(0)
+    for ref_roi in args.ref_roi:
+        if ref_roi not in REF_ROI_TABLE:
+            print('only '+', '.join(REF_ROI_TABLE)+' supported')
+            exit(1)
+    #one mask file per region not built from the parcellation
+    try:
+        mask_files = roi_mask_files(args.ref_roi, args.ref_roi_mask, args.mid_seg is not None)
+    except ValueError as e:
+        parser.error(str(e))
 
+    lean=args.load_mode=='lean'
+    #R reads and writes csv only, tables of an earlier python run in another format must not be read
+    lts_format=args.table_format if args.lts_engine=='python' else 'csv'
+    write_masks=args.mask_output!='sparse'
 
-    #load def fields
-    mid_to_bl_img = nib.load(args.mid_to_bl)
-    mid_to_bl_data = mid_to_bl_img.get_fdata()
-    
+    #with --bl_def/--bl_aff the SPM field is composed with the inverse T1 -> PET
+    #affine in memory (replaces reg_transform -invAff and -comp)
+    bl_aff = load_affine_txt(args.bl_aff) if args.bl_def else None
+    fu_aff = load_affine_txt(args.fu_aff) if args.fu_def else None
+    mid_to_bl_img = nib.load(args.bl_def if args.bl_def else args.mid_to_bl)
+    mid_to_fu_img = nib.load(args.fu_def if args.fu_def else args.mid_to_fu)
 
-    mid_to_fu_img = nib.load(args.mid_to_fu)
-    mid_to_fu_data = mid_to_fu_img.get_fdata()
-   
+    if args.save_def:
+        for tp, def_img, aff in (('baseline', mid_to_bl_img, bl_aff), ('followup', mid_to_fu_img, fu_aff)):
+            if aff is None:
+                continue
+            xfm_dir=os.path.join(data_root,subject_label,'ses-'+tp,'xfm')
+            np.savetxt(os.path.join(xfm_dir,subject_label+'_ses-'+tp+'_PET-to-T1.txt'), npl.inv(aff))
+            comp_data = compose_def_affine(np.asanyarray(def_img.dataobj), aff).astype(np.float32)
+            comp_img = nib.Nifti1Image(comp_data, affine=def_img.affine, header=def_img.header)
+            nib.save(comp_img, os.path.join(xfm_dir,subject_label+'_ses-'+tp+'_MID-to-PET_mapping_def.nii.gz'))
+            del comp_data
 
-    mid_to_bl_data = np.squeeze(mid_to_bl_data)
-    mid_to_fu_data = np.squeeze(mid_to_fu_data)
-    
-    
     mid_par_img = nib.load(args.mid_par)
-    mid_par_data = mid_par_img.get_fdata()
-
-    #whole cereb indicies
-    if args.ref_roi=='cereb':
-        ref_roi=args.ref_roi
-        ref_roi_ind = [39,40,41,42,72,73,74]
-        ref_roi_mask = ((mid_par_data == 39) |
-                        (mid_par_data == 40) |
-                        (mid_par_data == 41) |
-                        (mid_par_data == 42) |
-                        (mid_par_data == 72) |
-                        (mid_par_data == 73) |
-                        (mid_par_data == 74))
-        ref_roi_mask_int = np.array(ref_roi_mask,dtype = int)
-    elif args.ref_roi=='gm-cereb-clean':
-        if args.ref_roi_mask:
-            ref_roi=args.ref_roi
-            ref_roi_mask_img = nib.load(args.ref_roi_mask)
-            ref_roi_mask_data = ref_roi_mask_img.get_fdata()
-            ref_roi_mask_int = np.array(ref_roi_mask_data,dtype = int)
-        else:
-            print('cerebellar gm mask needed')
-            exit(1)
-    elif args.ref_roi=='wm-subcort-gif3':
-        if args.ref_roi_mask:
-            ref_roi=args.ref_roi
-            ref_roi_mask_img = nib.load(args.ref_roi_mask)
-            ref_roi_mask_data = ref_roi_mask_img.get_fdata()
-            ref_roi_mask_int = np.array(ref_roi_mask_data,dtype = int)
-        else:
-            print('wm-subcort-gif3 mask needed')
-            exit(1)
-    else:
-        print('only cereb, gm-cereb-clean and wm-subcort-gif3 supported')
-        exit(1)
-
-    
-    print('creating midpoint t1 int mask')
-    n=1
-    with np.nditer(ref_roi_mask_int, op_flags=['readwrite']) as it:
-        for vox in it:
-            if vox==1:
-                vox[...] = int(n)
-                n+=1
-
-    print('mask created')
     bl_pet_img = nib.load(args.bl_pet)
-    bl_pet_data = bl_pet_img.get_fdata()
-
     fu_pet_img = nib.load(args.fu_pet)
-    fu_pet_data = fu_pet_img.get_fdata()
-    
-    def get_mm_def(def_data,i,j,k):
-        x_mm = def_data[i,j,k,0]
-        y_mm = def_data[i,j,k,1]
-        z_mm = def_data[i,j,k,2]
-        return [x_mm,y_mm,z_mm]
-
-    def vox2mm(img,i,j,k):
-        M = img.affine[:3, :3]
-        abc = img.affine[:3, 3]
-        return M.dot([i,j,k]) + abc
-
-    def mm2vox(img,x,y,z):
-        M = npl.inv(img.affine)[:3, :3]
-        abc = npl.inv(img.affine)[:3, 3]
-        vox_array = M.dot([x,y,z]) + abc
-        return np.round(vox_array)
-
-    bl_mask = np.zeros(shape=bl_pet_data.shape, dtype = int)
-    fu_mask = np.zeros(shape=fu_pet_data.shape, dtype = int)
-
-    nvox = np.count_nonzero(ref_roi_mask_int)
-    print('number of voxels in region: ' + str(nvox))
-    
-    
-    roi_dict = {}
-    bl_dict = {}
-    fu_dict = {}
-    vox_values = np.zeros((nvox, 3))
-    
-
-
-    n=0
-    while n < nvox:
-        #print(n)
-        coord = np.nonzero(ref_roi_mask_int == int(n+1))
-        i,j,k = coord
-        x_mm,y_mm,z_mm = get_mm_def(mid_to_bl_data, int(i), int(j), int(k))
-        bl_i,bl_j,bl_k = mm2vox(bl_pet_img,x_mm,y_mm,z_mm)
-        x_mm,y_mm,z_mm = get_mm_def(mid_to_fu_data, int(i), int(j), int(k))
-        fu_i,fu_j,fu_k = mm2vox(fu_pet_img,x_mm,y_mm,z_mm)
-
-        vox_tup = ([int(bl_i),int(bl_j),int(bl_k)],[int(fu_i),int(fu_j),int(fu_k)])
-        if vox_tup not in roi_dict.values():
-            bl_tup = ([int(bl_i),int(bl_j),int(bl_k)])
-            fu_tup = ([int(fu_i),int(fu_j),int(fu_k)])
-            if bl_tup not in bl_dict.values() and fu_tup not in fu_dict.values():
-                roi_dict.update({str(n) : vox_tup})
-                bl_dict.update({str(n) : bl_tup})
-                fu_dict.update({str(n) : fu_tup})
-                bl_mask[int(bl_i),int(bl_j),int(bl_k)] = n
-                fu_mask[int(fu_i),int(fu_j),int(fu_k)] = n
-                #extract PET values at these voxels
-                bl_value = bl_pet_data[int(bl_i),int(bl_j),int(bl_k)]
-                fu_value = fu_pet_data[int(fu_i),int(fu_j),int(fu_k)]
-                print('vox: '+str(int(n+1))+', bl: '+str(bl_value)+', fu: '+str(fu_value))
-                vox_values[n, 0] = int(n+1)
-                vox_values[n, 1] = bl_value
-                vox_values[n, 2] = fu_value
-                
-
-        n+=1
-
-    
-    bl_mask_img = nib.Nifti1Image(bl_mask.astype(int), affine=bl_pet_img.affine, header=bl_pet_img.header)
-    fu_mask_img = nib.Nifti1Image(fu_mask.astype(int), affine=fu_pet_img.affine, header=fu_pet_img.header)
-    nib.save(bl_mask_img, os.path.join(bl_out_anat_dir,subject_label+'_ses-baseline_PET_'+ref_roi+'_mask.nii.gz'))
-    nib.save(fu_mask_img, os.path.join(fu_out_anat_dir,subject_label+'_ses-followup_PET_'+ref_roi+'_mask.nii.gz'))
-    mid_mask_img = nib.Nifti1Image(ref_roi_mask_int.astype(int), affine=mid_par_img.affine, header=mid_par_img.header)
-    nib.save(mid_mask_img, os.path.join(mid_out_anat_dir,subject_label+'_ses-midpoint_T1w_'+ref_roi+'_mask.nii.gz'))
-    #set header row
-    
-    df = pd.DataFrame(vox_values,columns=['voxel_number','baseline_uptake','followup_uptake'])
-    df.to_csv(csv_out_path,index=False)
-    
-    #run LTS R script, requires tidyverse,ggthemes,robustbase packages
-    rscript='/SAN/medic/insight46/scripts/long_suvr_compute_LTS.R'
-    r_cmd=['Rscript',rscript,csv_out_path,ref_roi,alpha]
-    print(r_cmd)
-    subprocess.call(r_cmd)
-    
-    print('get descriptives from non-zero')
-    nonzero_file=csv_out_path.replace('.csv','_nonzero.csv')
-    df = pd.read_csv(nonzero_file)
-    ##mean,sd and median,range for baseline and followup
-    ##don't include voxel_number column
-    cols=set(df.columns) - {"voxel_number"}
-    df1=df[list(cols)]
-    descriptives=df1.describe()
-    print(descriptives)
-    print('saving to file')
-    descriptives_file=csv_out_path.replace('.csv','_descriptive_stats.csv')
-    descriptives.to_csv(descriptives_file,index_label='statistic')
-    
-    outlier_file=csv_out_path.replace('.csv','_outlier_vox_list.csv')
-    outlier_df = pd.read_csv(outlier_file)
-    outlier_arr = outlier_df["voxel_number"].to_numpy()
-
-    print('creating baseline and followup PET outlier masks')
-    bl_outlier=bl_mask
-    with np.nditer(bl_outlier, op_flags=['readwrite']) as it:
-        for vox in it:
-            if vox in outlier_arr:
-                print('outlier vox: '+str(vox))
-                vox[...] = int(1)
+
+    #midpoint -> PET voxel correspondence of each roi, from the stage cache when the
+    #mapping inputs and parameters are unchanged (e.g. only --alpha or LTS settings
+    #changed). It depends on the PET grid and transform but not the PET values, so
+    #recons sharing them share the mapping and only gather their own uptake
+    cache_dir = args.cache_dir if args.cache_dir else os.path.join(data_root,'stage_cache')
+    use_cache = args.cache!='off'
+    mapping_inputs = {'def_bl': args.bl_def if args.bl_def else args.mid_to_bl,
+                      'def_fu': args.fu_def if args.fu_def else args.mid_to_fu}
+    mapping_params = {'stage': 'mapping', 'version': MAPPING_VERSION, 'sampling': args.sampling,
+                      'pet_bl': pet_geometry(bl_pet_img), 'pet_fu': pet_geometry(fu_pet_img),
+                      'aff_bl': None if bl_aff is None else np.round(bl_aff, 6).tolist(),
+                      'aff_fu': None if fu_aff is None else np.round(fu_aff, 6).tolist()}
+    mapped = {}
+    cache_keys = {}
+    claimed = []
+    map_rois = args.ref_roi + ([REGIONAL] if args.regional else [])
+    with stage(report,'cache'):
+        if use_cache:
+            os.makedirs(cache_dir, exist_ok=True)
+            for ref_roi in args.ref_roi:
+                spec = REF_ROI_TABLE[ref_roi]
+                roi_inputs = dict(mapping_inputs)
+                if ref_roi in mask_files:
+                    roi_inputs['roi_mask'] = mask_files[ref_roi]
+                else:
+                    roi_inputs['par'] = args.mid_par
+                    if 'tissue' in spec:
+                        roi_inputs['seg'] = args.mid_seg
+                params = dict(mapping_params, ref_roi=ref_roi, spec=spec)
+                cache_keys[ref_roi] = cache_key(input_digests(cache_dir, roi_inputs), params)
+                if args.cache=='on':
+                    hit = cache_get(cache_dir, cache_keys[ref_roi])
+                    if hit is not None:
+                        print(ref_roi+' mapping loaded from stage cache '+cache_keys[ref_roi][:12])
+                        mapped[ref_roi] = hit
+            if args.regional:
+                #all parcels only depend on the parcellation and the mapping
+                params = dict(mapping_params, ref_roi=REGIONAL)
+                cache_keys[REGIONAL] = cache_key(input_digests(cache_dir, dict(mapping_inputs, par=args.mid_par)), params)
+                if args.cache=='on':
+                    hit = cache_get(cache_dir, cache_keys[REGIONAL])
+                    if hit is not None:
+                        print('regional mapping loaded from stage cache '+cache_keys[REGIONAL][:12])
+                        mapped[REGIONAL] = hit
+            if args.cache=='on':
+                #claim the missing entries so concurrent jobs (e.g. the other recons) wait
+                #for this one instead of mapping again, or wait for and load theirs. Claims
+                #are taken in key order, so jobs never wait on each other in a cycle
+                for ref_roi in sorted((r for r in map_rois if r not in mapped), key=cache_keys.get):
+                    if cache_claim(cache_dir, cache_keys[ref_roi]):
+                        claimed.append(ref_roi)
+                        continue
+                    hit = cache_get(cache_dir, cache_keys[ref_roi])
+                    if hit is not None:
+                        print(ref_roi+' mapping loaded from stage cache '+cache_keys[ref_roi][:12]+' after waiting')
+                        mapped[ref_roi] = hit
+    missing = [ref_roi for ref_roi in map_rois if ref_roi not in mapped]
+
+    try:
+        if missing:
+            with stage(report,'load'):
+                #load def fields, in lean mode they are read later within the roi bounding box
+                if lean:
+                    mid_to_bl_data = mid_to_bl_img
+                    mid_to_fu_data = mid_to_fu_img
+                else:
+                    mid_to_bl_data = np.squeeze(mid_to_bl_img.get_fdata())
+                    mid_to_fu_data = np.squeeze(mid_to_fu_img.get_fdata())
+
+                mid_par_data = load_data(mid_par_img, lean)
+
+            with stage(report,'labelling'):
+                #integer labels once for all regions, masks are cached in the midpoint anat dir
+                mid_label_idx = label_index(mid_par_data)
+                mid_seg_img = nib.load(args.mid_seg) if args.mid_seg else None
+
+                rois=[]
+                for ref_roi in missing:
+                    if ref_roi==REGIONAL:
+                        #every labelled voxel, mapped with the reference regions
+                        coords, parcel_labels = parcel_voxels(mid_label_idx)
+                        print('labelled voxels for regional SUVR: '+str(len(coords)))
+                        rois.append((ref_roi, coords))
+                        continue
+                    if ref_roi in mask_files:
+                        ref_roi_mask_img = nib.load(mask_files[ref_roi])
+                        ref_roi_mask_data = load_data(ref_roi_mask_img, lean)
+                        ref_roi_mask_int = np.array(ref_roi_mask_data,dtype = int)
+                    else:
+                        ref_roi_mask_int = cached_ref_mask(ref_roi, mid_label_idx, mid_par_img,
+                                                           ref_mask_path(mid_out_anat_dir, subject_label, ref_roi),
+                                                           mid_seg_img)
+
+                    print('creating midpoint t1 int mask: '+ref_roi)
+                    #number roi voxels 1..nvox, coords row n is voxel n+1
+                    ref_roi_mask_int, coords = label_roi(ref_roi_mask_int)
+                    rois.append((ref_roi, coords))
+
+                print('mask created')
+
+            with stage(report,'mapping'):
+                bl_map_affine = pet_mapping_affine(bl_pet_img.affine, bl_aff)
+                fu_map_affine = pet_mapping_affine(fu_pet_img.affine, fu_aff)
+
+                #map the union of all roi voxels through both deformation fields in one go
+                all_coords = np.vstack([coords for _, coords in rois])
+                union_coords, union_index = np.unique(all_coords, axis=0, return_inverse=True)
+                union_index = union_index.reshape(-1)
+                print('number of voxels in all regions: ' + str(len(union_coords)))
+                if args.sampling=='trilinear':
+                    bl_pts_all, fu_pts_all = map_roi_points(union_coords, mid_to_bl_data, mid_to_fu_data,
+                                                            bl_map_affine, fu_map_affine)
+                else:
+                    bl_vox_all, fu_vox_all = map_roi_voxels(union_coords, mid_to_bl_data, mid_to_fu_data,
+                                                            bl_map_affine, fu_map_affine)
+
+            start = 0
+            for ref_roi, coords in rois:
+                nvox = len(coords)
+                #rows of the union for this roi's voxels, in voxel number order
+                sel = union_index[start:start+nvox]
+                start += nvox
+
+                if ref_roi==REGIONAL:
+                    #regional means use every voxel, no dedup
+                    mapped[ref_roi] = {'coords': coords, 'labels': parcel_labels}
+                    if args.sampling=='trilinear':
+                        mapped[ref_roi].update(bl_pts=bl_pts_all[sel], fu_pts=fu_pts_all[sel])
+                    else:
+                        mapped[ref_roi].update(bl_vox=bl_vox_all[sel], fu_vox=fu_vox_all[sel])
+                elif args.sampling=='trilinear':
+                    #sub-voxel PET sampling, every roi voxel gets a value so no dedup needed
+                    print(ref_roi+' trilinear sampling, all '+str(nvox)+' voxels kept')
+                    mapped[ref_roi] = {'coords': coords, 'bl_pts': bl_pts_all[sel], 'fu_pts': fu_pts_all[sel]}
+                else:
+                    bl_vox = bl_vox_all[sel]
+                    fu_vox = fu_vox_all[sel]
+
+                    #drop midpoint voxels whose baseline or followup PET voxel is already taken
+                    with stage(report,'dedup'):
+                        keep, collisions = dedup_voxel_pairs(bl_vox, fu_vox, bl_pet_img.shape, fu_pet_img.shape)
+                        print(ref_roi+' voxels kept: '+str(collisions['kept'])+', dropped: '+str(collisions['dropped']))
+                        print('baseline collisions: '+str(collisions['baseline_collisions'])+
+                              ', followup collisions: '+str(collisions['followup_collisions']))
+                    mapped[ref_roi] = {'coords': coords, 'bl_vox': bl_vox, 'fu_vox': fu_vox, 'keep': keep}
+
+                with stage(report,'cache'):
+                    if use_cache:
+                        cache_put(cache_dir, cache_keys[ref_roi], mapped[ref_roi],
+                                  {'subject': subject_label, 'ref_roi': ref_roi, 'stage': 'mapping'})
+                    if ref_roi in claimed:
+                        cache_release(cache_dir, cache_keys[ref_roi])
+            with stage(report,'cache'):
+                if use_cache:
+                    cache_evict(cache_dir, args.cache_max_gb * 1e9)
+    finally:
+        #claims of entries not stored (e.g. the mapping failed) are given up
+        for ref_roi in claimed:
+            cache_release(cache_dir, cache_keys[ref_roi])
+
+    #uptake from this recon's PET, in lean mode only the mapped voxels bounding box is read
+    with stage(report,'load'):
+        if lean:
+            bl_pet_data = bl_pet_img
+            fu_pet_data = fu_pet_img
+        else:
+            bl_pet_data = bl_pet_img.get_fdata()
+            fu_pet_data = fu_pet_img.get_fdata()
+
+    ref_uptake = {}
+    for ref_roi in args.ref_roi:
+        coords = mapped[ref_roi]['coords']
+        nvox = len(coords)
+        vox_values = np.zeros((nvox, 3))
+        with stage(report,'gather'):
+            if args.sampling=='trilinear':
+                bl_pts = mapped[ref_roi]['bl_pts']
+                fu_pts = mapped[ref_roi]['fu_pts']
+                #PET masks use the nearest PET voxel
+                bl_vox = np.round(bl_pts).astype(int)
+                fu_vox = np.round(fu_pts).astype(int)
+                vox_values[:, 0] = np.arange(1, nvox + 1)
+                vox_values[:, 1] = trilinear_values(bl_pet_data, bl_pts)
+                vox_values[:, 2] = trilinear_values(fu_pet_data, fu_pts)
             else:
-                vox[...] = int(0)
-
-    fu_outlier=fu_mask
-    with np.nditer(fu_outlier, op_flags=['readwrite']) as it:
-        for vox in it:
-            if vox in outlier_arr:
-                print('outlier vox: '+str(vox))
-                vox[...] = int(1)
+                bl_vox = mapped[ref_roi]['bl_vox']
+                fu_vox = mapped[ref_roi]['fu_vox']
+                #PET values at the kept voxels, voxel number 0 marks dropped voxels
+                kept_n = np.flatnonzero(mapped[ref_roi]['keep'])
+                vox_values[kept_n, 0] = kept_n + 1
+                vox_values[kept_n, 1] = gather_values(bl_pet_data, bl_vox[kept_n])
+                vox_values[kept_n, 2] = gather_values(fu_pet_data, fu_vox[kept_n])
+
+        print(ref_roi)
+        print('number of voxels in region: ' + str(nvox))
+        csv_out_path=os.path.join(mid_out_pet_dir,subject_label+'_ses-midpoint_long_'+ref_roi+'_pet_uptake.csv')
+
+        if write_masks:
+            with stage(report,'mask_write'):
+                #voxel number label masks, written with the PET header dtype
+                ref_roi_mask_int = label_coords(mid_par_img.shape[:3], coords)
+                bl_mask = np.zeros(shape=bl_pet_img.shape, dtype = np.int32)
+                fu_mask = np.zeros(shape=fu_pet_img.shape, dtype = np.int32)
+                if args.sampling=='trilinear':
+                    #PET masks label each nearest PET voxel with the first voxel number mapped to it
+                    label_nearest(bl_mask, bl_vox)
+                    label_nearest(fu_mask, fu_vox)
+                else:
+                    #PET masks are labelled with the voxel number, same as the midpoint int mask
+                    bl_mask[tuple(bl_vox[kept_n].T)] = kept_n + 1
+                    fu_mask[tuple(fu_vox[kept_n].T)] = kept_n + 1
+
+                bl_mask_img = nib.Nifti1Image(bl_mask, affine=bl_pet_img.affine, header=bl_pet_img.header)
+                fu_mask_img = nib.Nifti1Image(fu_mask, affine=fu_pet_img.affine, header=fu_pet_img.header)
+                nib.save(bl_mask_img, os.path.join(bl_out_anat_dir,subject_label+'_ses-baseline_PET_'+ref_roi+'_mask.nii.gz'))
+                nib.save(fu_mask_img, os.path.join(fu_out_anat_dir,subject_label+'_ses-followup_PET_'+ref_roi+'_mask.nii.gz'))
+                mid_mask_img = nib.Nifti1Image(ref_roi_mask_int, affine=mid_par_img.affine, header=mid_par_img.header)
+                nib.save(mid_mask_img, os.path.join(mid_out_anat_dir,subject_label+'_ses-midpoint_T1w_'+ref_roi+'_mask.nii.gz'))
+        #set header row
+
+        with stage(report,'table_write'):
+            #R reads the csv, so it is always written for --lts_engine R
+            df = uptake_table(vox_values, coords, bl_vox, fu_vox)
+            write_table(df, csv_out_path, args.table_format, args.export_csv or args.lts_engine=='R')
+
+        with stage(report,'lts'):
+            if args.lts_engine=='R':
+                #run LTS R script, requires tidyverse,ggthemes,robustbase packages
+                rscript='/SAN/medic/insight46/scripts/long_suvr_compute_LTS.R'
+                #R writes no _LTS_summary, one from an earlier python run would be plotted
+                summary_file=csv_out_path.replace('.csv','_LTS_summary.csv')
+                if os.path.exists(summary_file):
+                    os.remove(summary_file)
+                #plots are drawn by the plots stage (--plots), not by R
+                r_cmd=['Rscript',rscript,csv_out_path,ref_roi,alpha,'noplots']
+                print(r_cmd)
+                subprocess.call(r_cmd)
             else:
-                vox[...] = int(0)
+                print('running LTS')
+                compute_lts(csv_out_path,ref_roi,path=args.lts_path,
+                            n_jobs=args.lts_jobs,parallel_directions=args.lts_parallel,
+                            fmt=args.table_format,export_csv=args.export_csv,report=report)
 
-    bl_outlier_img = nib.Nifti1Image(bl_outlier.astype(bool), affine=bl_pet_img.affine, header=bl_pet_img.header)
-    fu_outlier_img = nib.Nifti1Image(fu_outlier.astype(bool), affine=fu_pet_img.affine, header=fu_pet_img.header)
-    nib.save(bl_outlier_img, os.path.join(bl_out_anat_dir,subject_label+'_ses-baseline_PET_'+ref_roi+'_outlier_mask_alpha-'+alpha+'_.nii.gz'))
-    nib.save(fu_outlier_img, os.path.join(fu_out_anat_dir,subject_label+'_ses-followup_PET_'+ref_roi+'_outlier_mask_alpha-'+alpha+'_.nii.gz'))
+        with stage(report,'descriptives'):
+            print('get descriptives from non-zero')
+            nonzero_file=csv_out_path.replace('.csv','_nonzero.csv')
+            df = read_table(nonzero_file, lts_format)
+            ##mean,sd and median,range for baseline and followup
+            ##don't include voxel_number or coordinate columns
+            cols=[c for c in df.columns if c.endswith('_uptake')]
+            df1=df[list(cols)]
+            descriptives=df1.describe()
+            print(descriptives)
+            print('saving to file')
+            descriptives_file=csv_out_path.replace('.csv','_descriptive_stats.csv')
+            descriptives.to_csv(descriptives_file,index_label='statistic')
 
-    
-            
-                
+        if args.plots!='off':
+            with stage(report,'plots'):
+                print('plotting LTS ('+args.plots+')')
+                plot_lts(csv_out_path,ref_roi,style=args.plots,fmt=lts_format)
 
-    
-                
-    
+        with stage(report,'outlier_masks'):
+            outlier_file=csv_out_path.replace('.csv','_outlier_vox_list.csv')
+            outlier_df = read_table(outlier_file, lts_format)
+            outlier_arr = outlier_df["voxel_number"].to_numpy()
 
-    
+            print('number of outlier voxels: ' + str(len(outlier_arr)))
+            if write_masks:
+                print('creating baseline, followup PET and midpoint T1 outlier masks')
+                bl_outlier, fu_outlier, mid_outlier = outlier_masks(outlier_arr, nvox, bl_mask, fu_mask, ref_roi_mask_int)
 
-    
+                bl_outlier_img = nib.Nifti1Image(bl_outlier, affine=bl_pet_img.affine, header=bl_pet_img.header)
+                fu_outlier_img = nib.Nifti1Image(fu_outlier, affine=fu_pet_img.affine, header=fu_pet_img.header)
+                mid_outlier_img = nib.Nifti1Image(mid_outlier, affine=mid_par_img.affine, header=mid_par_img.header)
+                nib.save(bl_outlier_img, os.path.join(bl_out_anat_dir,subject_label+'_ses-baseline_PET_'+ref_roi+'_outlier_mask_alpha-'+alpha+'_.nii.gz'))
+                nib.save(fu_outlier_img, os.path.join(fu_out_anat_dir,subject_label+'_ses-followup_PET_'+ref_roi+'_outlier_mask_alpha-'+alpha+'_.nii.gz'))
+                nib.save(mid_outlier_img, os.path.join(mid_out_anat_dir,subject_label+'_ses-midpoint_T1w_'+ref_roi+'_outlier_mask_alpha-'+alpha+'_.nii.gz'))
+
+        if args.mask_output!='nifti':
+            with stage(report,'correspondence'):
+                #every voxel pair with coordinates, uptake and outlier flag in one small file
+                corr_file=os.path.join(mid_out_pet_dir,subject_label+'_ses-midpoint_long_'+ref_roi+'_alpha-'+alpha+CORRESPONDENCE_SUFFIX)
+                write_correspondence(corr_file, ref_roi, vox_values, coords, bl_vox, fu_vox, outlier_arr,
+                                     (mid_par_img, bl_pet_img, fu_pet_img))
+                print('voxel correspondence written to '+corr_file)
+
+        #reference uptake without the LTS outliers, for regional SUVR
+        ref_uptake[ref_roi] = cleaned_reference(vox_values, outlier_arr)
+
+    if args.regional:
+        with stage(report,'regional'):
+            regional = mapped[REGIONAL]
+            if args.sampling=='trilinear':
+                inside = in_volume(np.round(regional['bl_pts']), bl_pet_img.shape) & \
+                         in_volume(np.round(regional['fu_pts']), fu_pet_img.shape)
+                bl_values = trilinear_values(bl_pet_data, regional['bl_pts'][inside])
+                fu_values = trilinear_values(fu_pet_data, regional['fu_pts'][inside])
+            else:
+                #voxels mapped outside either PET volume are left out
+                inside = in_volume(regional['bl_vox'], bl_pet_img.shape) & \
+                         in_volume(regional['fu_vox'], fu_pet_img.shape)
+                bl_values = gather_values(bl_pet_data, regional['bl_vox'][inside])
+                fu_values = gather_values(fu_pet_data, regional['fu_vox'][inside])
+            print('regional SUVR: '+str(int(inside.sum()))+' of '+str(len(inside))+' labelled voxels inside both PET volumes')
+            regional_df = regional_table(regional['labels'][inside], bl_values, fu_values, ref_uptake)
+            regional_file=os.path.join(mid_out_pet_dir,subject_label+'_ses-midpoint_long_regional_suvr_alpha-'+alpha+'.csv')
+            regional_df.to_csv(regional_file,index=False)
+            print('regional SUVR written to '+regional_file)
 
+    print_report(report)
+    write_report(report, os.path.join(mid_out_pet_dir,subject_label+'_ses-midpoint_long_voxel_mapping'+REPORT_SUFFIX))
+    print('peak RSS (MB): ' + str(round(peak_rss_mb(), 1)))
@@ -0,0 +1,194 @@
+'''
+Run longitudinal SUVR voxel mapping for a whole job list in one process pool
+
+Takes the job csv(s) written by check_long_suvr_voxel_mapping.py and runs
+run_long_suvr_voxel_mapping.py for each subject inside worker processes, so
+python, nibabel and pandas start once per worker rather than once per subject.
+Arguments are the same as submit_long_suvr_voxel_mapping.sh uses, any unknown
+arguments (e.g. --load_mode lean --table_format npz) are passed on.
+
+With job csvs of several recons the recons of a subject run one after the
+other in the same worker with a shared stage cache, so recons with the same
+PET grid and T1 -> PET transform map the voxels once and only gather uptake.
+
+A failing subject is recorded and does not stop the others. Each finished
+subject is appended to a ledger (json lines). When the batch is run again
+subjects already done are skipped, failed ones only rerun with --retry_failed,
+interrupted ones (worker died) always rerun.
+
+usage: python run_long_suvr_voxel_mapping_batch.py <job csv> [<job csv> ...] --workers 8
+'''
+import argparse
+import contextlib
+import csv
+import datetime as dt
+import json
+import logging
+import os
+import runpy
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+SCRIPTFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run_long_suvr_voxel_mapping.py')
+
+
+def job_args(row, root_dir, ref_rois, alpha, extra):
+    '''
+    output dir and run_long_suvr_voxel_mapping.py arguments for one job csv
+    row, as in submit_long_suvr_voxel_mapping.sh
+    '''
+    subject = row['subject_label']
+    subject_label = 'sub-' + subject
+    out_dir = os.path.join(root_dir, 'analysis', 'longitudinal_pet_voxel_mapping_' + row['recon'])
+    t1_seg = os.path.join(root_dir, 'analysis', 'gif', subject_label, 'ses-midpoint', 'anat',
+                          subject_label + '_ses-midpoint_T1w_run-1_desc-gradwarp_spm-midpoint_seg.nii.gz')
+    argv = ['--subject', subject,
+            '--bl_def', row['bl_t1_to_mid_def'], '--bl_aff', row['bl_t1_to_pet_tx'],
+            '--fu_def', row['fu_t1_to_mid_def'], '--fu_aff', row['fu_t1_to_pet_tx'],
+            '--mid_par', row['gif_midpoint'],
+            '--bl_pet', row['bl_pet_recon'], '--fu_pet', row['fu_pet_recon'],
+            '--ref_roi'] + ref_rois + ['--mid_seg', t1_seg,
+            '--root_dir', out_dir, '--alpha', str(alpha)] + extra
+    if '--cache_dir' not in extra:
+        #shared by all recons so they can share the voxel mapping
+        argv += ['--cache_dir', os.path.join(root_dir, 'analysis', 'stage_cache')]
+    return out_dir, argv
+
+
+def make_out_dirs(out_dir, subject_label):
+    for ses, sub_dirs in (('baseline', ['anat', 'xfm']), ('followup', ['anat', 'xfm']),
+                          ('midpoint', ['anat', 'pet'])):
+        for sub_dir in sub_dirs:
+            os.makedirs(os.path.join(out_dir, subject_label, 'ses-' + ses, sub_dir), exist_ok=True)
+
+
+def run_job(job_id, out_dir, argv, log_file):
+    '''
+    run the mapping script for one subject in this process, output to log_file
+    returns (job_id, error, started), error is None on success
+    '''
+    started = dt.datetime.now().isoformat()
+    make_out_dirs(out_dir, 'sub-' + argv[1])
+    old_argv = sys.argv
+    sys.argv = [SCRIPTFILE] + argv
+    #the script's logging handler writes to this job's log, restored when the log is closed
+    root_logger = logging.getLogger()
+    old_handlers, old_level = root_logger.handlers[:], root_logger.level
+    error = None
+    with open(log_file, 'w') as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        print(' '.join(['python'] + sys.argv))
+        try:
+            runpy.run_path(SCRIPTFILE, run_name='__main__')
+        except SystemExit as e:
+            #exit(1) and parser.error in the script
+            if e.code:
+                error = 'exit ' + str(e.code)
+        except Exception:
+            error = traceback.format_exc()
+            print(error)
+        finally:
+            sys.argv = old_argv
+            for handler in root_logger.handlers[:]:
+                if handler not in old_handlers:
+                    root_logger.removeHandler(handler)
+                    handler.close()
+            root_logger.handlers[:] = old_handlers
+            root_logger.setLevel(old_level)
+    return job_id, error, started
+
+
+def run_jobs(jobs):
+    #run (job_id, out_dir, argv, log_file) jobs one after the other
+    return [run_job(*job) for job in jobs]
+
+
+def read_ledger(ledger):
+    #latest status of each job in the ledger
+    status = {}
+    if os.path.exists(ledger):
+        with open(ledger) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    status[entry['job']] = entry
+    return status
+
+
+def append_ledger(ledger, entry):
+    with open(ledger, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('jobs', type=str, nargs='+',
+                        help='job csv(s) from check_long_suvr_voxel_mapping.py, e.g. one per recon')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of subjects run at the same time')
+    parser.add_argument('--ledger', type=str,
+                        help='progress ledger, default <first job csv>.ledger')
+    parser.add_argument('--log_dir', type=str,
+                        help='per subject logs, default <first job csv>_logs')
+    parser.add_argument('--retry_failed', action='store_true',
+                        help='also rerun subjects that failed in a previous run')
+    parser.add_argument('--ref_roi', type=str, nargs='+', default=['cereb', 'gm-cereb-clean'],
+                        help='reference region(s)')
+    parser.add_argument('--alpha', type=float, default=0.75,
+                        help='alpha value for LTS regression')
+    parser.add_argument('--root_dir', type=str, default='/SAN/medic/insight46',
+                        help='Root directory')
+    args, extra = parser.parse_known_args()
+
+    ledger = args.ledger if args.ledger else args.jobs[0] + '.ledger'
+    log_dir = args.log_dir if args.log_dir else os.path.splitext(args.jobs[0])[0] + '_logs'
+    os.makedirs(log_dir, exist_ok=True)
+
+    rows = []
+    for jobs_csv in args.jobs:
+        with open(jobs_csv, newline='') as f:
+            rows += list(csv.DictReader(f))
+    status = read_ledger(ledger)
+
+    jobs = {}
+    subject_jobs = {}
+    for row in rows:
+        job_id = row['recon'] + '_sub-' + row['subject_label']
+        previous = status.get(job_id, {}).get('status')
+        if previous == 'done' or (previous == 'failed' and not args.retry_failed):
+            print(job_id + ' ' + previous + ' in ledger, skipping')
+            continue
+        out_dir, argv = job_args(row, args.root_dir, args.ref_roi, args.alpha, extra)
+        jobs[job_id] = (out_dir, argv, os.path.join(log_dir, job_id + '.log'))
+        subject_jobs.setdefault(row['subject_label'], []).append((job_id,) + jobs[job_id])
+    print(str(len(jobs)) + ' of ' + str(len(rows)) + ' jobs to run on ' + str(args.workers) + ' workers')
+
+    n_failed = 0
+    with ProcessPoolExecutor(args.workers) as executor:
+        futures = {executor.submit(run_jobs, sub_jobs): sub_jobs for sub_jobs in subject_jobs.values()}
+        for future in as_completed(futures):
+            try:
+                results = future.result()
+            except BrokenProcessPool:
+                #a worker died (e.g. out of memory), the jobs it took down are rerun next time
+                results = [(job[0], 'worker process died', None) for job in futures[future]]
+            for job_id, error, started in results:
+                if error == 'worker process died':
+                    job_status = 'interrupted'
+                else:
+                    job_status = 'failed' if error else 'done'
+                entry = {'job': job_id, 'status': job_status, 'log': jobs[job_id][2],
+                         'started': started, 'finished': dt.datetime.now().isoformat()}
+                if error:
+                    entry['error'] = error.strip().split('\n')[-1]
+                    n_failed += 1
+                append_ledger(ledger, entry)
+                print(job_id + ' ' + entry['status'] + (': ' + entry['error'] if error else ''))
+
+    print(str(len(jobs) - n_failed) + ' done, ' + str(n_failed) + ' failed, ledger: ' + ledger)
+    if n_failed:
+        exit(1)
@@ -2,61 +2,50 @@ import argparse
 #import pandas as pd
 import subprocess
 import os
+import csv
 from glob import glob
 import requests
 import tempfile
+import time
+import shutil
 from utils import refresh_cookies,get_credentials,get_nifti,get_dicom
 from datetime import datetime,timedelta
 from shutil import copy2
+from stage_report import new_report,stage,write_report,print_report,REPORT_SUFFIX
+from stage_files import stage_in,stage_out_all
 
 
 #TEST RUN SCRIPT FOR MIDPOINT REG
+#single subject: --subject --bl_session --fu_session --bl_t1 --fu_t1
+#batch: --batch <job csv from check_midpoint.py>, pairs are registered in
+#chunks of --chunk_size, each chunk in one matlab session (long_pairwise_job
+#with a pairs csv), a failing subject is recorded in the manifest and the
+#others carry on. Each pair's outputs are collected as soon as it is in the
+#manifest and its scratch files deleted, so scratch holds at most one chunk
+#of staged T1s and the outputs of the pair being registered
 
-parser = argparse.ArgumentParser(description='Midpoint T1')
-parser.add_argument('--subject',type=str,
-                    help='Subject ID')
-parser.add_argument('--bl_session',type=str,
-                    help='Baseline PET-MR session')
-parser.add_argument('--fu_session',type=str,
-                    help='Followup PET-MR session')
-parser.add_argument('--bl_t1',type=str,
-                    help='Baseline T1 Scan ID to use')
-parser.add_argument('--fu_t1',type=str,
-                    help='Followup T1 Scan ID to use')
-parser.add_argument('--root_dir', type=str,
-                    default='/SAN/medic/insight46',
-                    help='Root directory')
-parser.add_argument('--spm_dir', type=str,
-                    help='SPM directory')
-parser.add_argument('--scratch_dir', type=str,
-                    help='Temp working directory')
-args=parser.parse_args()
+#Set up scripts dir for SPM to find 'long_pairwise_job.m' file
+scripts_dir='/SAN/medic/insight46/scripts/'
+#pairs staged to scratch and registered per matlab session, two uncompressed
+#T1s per pair, sized for tscratch in submit_midpoint_batch.sh
+CHUNK_SIZE=20
+#seconds between manifest checks while matlab runs
+POLL_S=30
 
-if not args.bl_t1:
-    parser.error('Submit needs --bl_t1')
-elif not args.fu_t1:
-    parser.error('Submit needs --fu_t1')
-else:
-    if args.root_dir:
-        data_root=args.root_dir
-    else:
-        data_root='/SAN/medic/insight46'
-    if args.spm_dir:
-        spm_dir=args.spm_dir
-    else:
-        parser.error('Need --spm_dir')
-    if args.scratch_dir:
-        working_dir=args.scratch_dir
-    else:
-        parser.error('Need --scratch_dir')
 
-    subject_label='sub-' + args.subject
-    print('Subject label: ' + subject_label )
-    orig_bl_t1_path=args.bl_t1
+def spm_name(subject_label,ses):
+    return subject_label+'_ses-'+ses+'_T1w_run-1_desc-gradwarp_spm-midpoint'
+
+
+def prepare_subject(subject_label,bl_session,fu_session,orig_bl_t1_path,orig_fu_t1_path,
+                    data_root,working_dir,report):
+    '''
+    copy and unzip the T1s to scratch for SPM and write the scan interval,
+    returns (bl_t1_spm_path,fu_t1_spm_path,yrs_dif,out_dir,xfm_dir)
+    '''
     print('Baseline T1 path: ' + orig_bl_t1_path)
-    orig_fu_t1_path=args.fu_t1
     print('fu_t1_path: ' + orig_fu_t1_path)
-    
+
     #make new working for baseline and followup 
     tmp_bl_dir=os.path.join(working_dir,subject_label,'ses-baseline','anat')
     tmp_fu_dir=os.path.join(working_dir,subject_label,'ses-followup','anat')
@@ -72,22 +61,21 @@ else:
                                  subject_label,'ses-midpoint','xfm')
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
-        if not os.path.exists(xfm_dir):
-            os.makedirs(xfm_dir)
+    if not os.path.exists(xfm_dir):
+        os.makedirs(xfm_dir)
     ### SPM
     
-    #make copy of T1 if it doesn't exist, for SPM
-    bl_t1_spm_path=os.path.join(tmp_bl_dir,subject_label+'_ses-baseline_T1w_run-1_desc-gradwarp_spm-midpoint.nii.gz')
-    fu_t1_spm_path=os.path.join(tmp_fu_dir,subject_label+'_ses-followup_T1w_run-1_desc-gradwarp_spm-midpoint.nii.gz')
-    if not os.path.exists(bl_t1_spm_path):
-        copy2(orig_bl_t1_path,bl_t1_spm_path)
-    if not os.path.exists(fu_t1_spm_path):
-        copy2(orig_fu_t1_path,fu_t1_spm_path)
+    #unzipped copy of T1 if it doesn't exist, for SPM, decompressed straight from the source
+    bl_t1_spm_path=os.path.join(tmp_bl_dir,spm_name(subject_label,'baseline')+'.nii')
+    fu_t1_spm_path=os.path.join(tmp_fu_dir,spm_name(subject_label,'followup')+'.nii')
+    with stage(report,'stage_in'):
+        stage_in(orig_bl_t1_path,bl_t1_spm_path)
+        stage_in(orig_fu_t1_path,fu_t1_spm_path)
 
     #get scan time difference for SPM12 from sessions
-    bl_scan_date_str=args.bl_session.split('_')[3]
+    bl_scan_date_str=bl_session.split('_')[3]
     bl_scan_date=datetime.strptime(bl_scan_date_str, '%Y%m%d')
-    fu_scan_date_str=args.fu_session.split('_')[3]
+    fu_scan_date_str=fu_session.split('_')[3]
     fu_scan_date=datetime.strptime(fu_scan_date_str, '%Y%m%d')
     print('Baseline Scan Date: ' + str(bl_scan_date))
     print('Followup Scan Date: ' + str(fu_scan_date))
@@ -97,48 +85,226 @@ else:
     f = open(os.path.join(xfm_dir,subject_label+"_scan_interval_yrs.txt"), "w") 
     f.write(str(yrs_dif)) 
     f.close() 
-    
-    #Set up scripts dir for SPM to find 'long_pairwise_job.m' file
-    scripts_dir='/SAN/medic/insight46/scripts/'
-    
-    #unzip files for SPM
-    gunzip_cmd=['gunzip',bl_t1_spm_path,fu_t1_spm_path]
-    subprocess.call(gunzip_cmd)
-    #update file names to unzipped
-    bl_t1_spm_path=bl_t1_spm_path.replace(".nii.gz", ".nii")
-    fu_t1_spm_path=fu_t1_spm_path.replace(".nii.gz", ".nii")
+    return bl_t1_spm_path,fu_t1_spm_path,yrs_dif,out_dir,xfm_dir
 
-    #create SPM submit command, then call it
-    spm_cmd="matlab -nosplash -nodesktop -r \"addpath([\'"+scripts_dir+"\']) ; long_pairwise_job(\'"+bl_t1_spm_path+"\',\'"+fu_t1_spm_path+"\',"+str(yrs_dif)+",\'"+spm_dir+"\') ; exit\""
-    print(spm_cmd)
-    subprocess.call(spm_cmd,shell=True)
-    
-    #re-zip and copy files to output dir
-    avg=os.path.join(working_dir,subject_label,'ses-baseline','anat','avg_'+subject_label+'_ses-baseline_T1w_run-1_desc-gradwarp_spm-midpoint.nii')
+
+def spm_command(matlab_call):
+    #matlab command line running matlab_call with the scripts dir on the path
+    return "matlab -nosplash -nodesktop -r \"addpath([\'"+scripts_dir+"\']) ; "+matlab_call+" ; exit\""
+
+
+def collect_outputs(subject_label,working_dir,out_dir,xfm_dir,report):
+    #zip files straight to the output dir, all at the same time
+    avg=os.path.join(working_dir,subject_label,'ses-baseline','anat','avg_'+spm_name(subject_label,'baseline')+'.nii')
+    avg_target=os.path.join(out_dir,spm_name(subject_label,'midpoint')+'.nii.gz')
+    xfm_list=[os.path.join(working_dir,subject_label,'ses-baseline','anat','dv_'+spm_name(subject_label,'baseline')+'_'+spm_name(subject_label,'followup')+'.nii'),
+              os.path.join(working_dir,subject_label,'ses-baseline','anat','y_'+spm_name(subject_label,'baseline')+'.nii'),
+              os.path.join(working_dir,subject_label,'ses-followup','anat','y_'+spm_name(subject_label,'followup')+'.nii'),
+              os.path.join(working_dir,subject_label,'ses-baseline','anat','jd_'+spm_name(subject_label,'baseline')+'_'+spm_name(subject_label,'followup')+'.nii')]
+
+    out_files=[]
     if os.path.exists(avg):
-        print("zipping "+avg)
-        zip_cmd=['gzip',avg]
-        subprocess.call(zip_cmd)
-        avg_source=avg.replace(".nii", ".nii.gz")
-        avg_target=os.path.join(out_dir,subject_label+'_ses-midpoint_T1w_run-1_desc-gradwarp_spm-midpoint.nii.gz')
-        print("copying "+avg_source+" to "+avg_target)
-        copy2(avg_source,avg_target)
-
-    xfm_list=[os.path.join(working_dir,subject_label,'ses-baseline','anat','dv_'+subject_label+'_ses-baseline_T1w_run-1_desc-gradwarp_spm-midpoint_'+subject_label+'_ses-followup_T1w_run-1_desc-gradwarp_spm-midpoint.nii'),
-              os.path.join(working_dir,subject_label,'ses-baseline','anat','y_'+subject_label+'_ses-baseline_T1w_run-1_desc-gradwarp_spm-midpoint.nii'),
-              os.path.join(working_dir,subject_label,'ses-followup','anat','y_'+subject_label+'_ses-followup_T1w_run-1_desc-gradwarp_spm-midpoint.nii'),
-              os.path.join(working_dir,subject_label,'ses-baseline','anat','jd_'+subject_label+'_ses-baseline_T1w_run-1_desc-gradwarp_spm-midpoint_'+subject_label+'_ses-followup_T1w_run-1_desc-gradwarp_spm-midpoint.nii')]
-    
+        out_files.append((avg,avg_target))
     for spm_file in xfm_list:
         if os.path.exists(spm_file):
-            print("zipping "+spm_file)
-            zip_cmd=['gzip',spm_file]
-            subprocess.call(zip_cmd)
-            spm_file=str(spm_file.replace(".nii", ".nii.gz"))
-            print("copying "+spm_file+" to "+xfm_dir)
-            copy2(spm_file,xfm_dir)
+            out_files.append((spm_file,os.path.join(xfm_dir,os.path.basename(spm_file)+'.gz')))
         else:
             print(spm_file+" doesn't exist")
+    for spm_file,target in out_files:
+        print("zipping "+spm_file+" to "+target)
+    with stage(report,'stage_out'):
+        stage_out_all(out_files)
+
+
+def write_subject_report(report,subject_label,xfm_dir):
+    print_report(report)
+    write_report(report,os.path.join(xfm_dir,subject_label+'_ses-midpoint_midpoint'+REPORT_SUFFIX))
+
+
+def read_manifest(manifest):
+    #manifest entries by bl_t1, only complete lines (matlab appends one per pair as it finishes)
+    status={}
+    if os.path.exists(manifest):
+        with open(manifest,newline='') as f:
+            lines=f.read().split('\n')
+        #the last piece is empty or a line still being written
+        for entry in csv.DictReader(lines[:-1]):
+            status[entry['bl_t1']]=entry
+    return status
+
+
+def clean_subject(subject_label,working_dir):
+    #remove a subject's staged T1s and SPM outputs from scratch
+    shutil.rmtree(os.path.join(working_dir,subject_label),ignore_errors=True)
+
+
+def run_chunk(rows,data_root,working_dir,spm_dir,manifest):
+    '''
+    register the subjects of rows in one matlab session, collecting and
+    cleaning each pair as soon as it is in the manifest
+    returns the number of failed subjects
+    '''
+    #prepare every subject, one that can't be prepared is left out of the batch
+    prepared={}
+    n_failed=0
+    for row in rows:
+        subject_label='sub-' + row['subject_label']
+        print('Subject label: ' + subject_label )
+        report=new_report(__file__,subject_label)
+        try:
+            bl_t1_spm_path,fu_t1_spm_path,yrs_dif,out_dir,xfm_dir=prepare_subject(
+                subject_label,row['baseline_session'],row['followup_session'],
+                row['baseline_t1'],row['followup_t1'],data_root,working_dir,report)
+        except Exception as e:
+            print(subject_label+' preparation failed: '+str(e))
+            clean_subject(subject_label,working_dir)
+            n_failed+=1
+            continue
+        prepared[bl_t1_spm_path]=(subject_label,fu_t1_spm_path,yrs_dif,out_dir,xfm_dir,report)
+
+    if not prepared:
+        print('No subjects to register')
+        return n_failed
+
+    #pairs for long_pairwise_job, bl_t1,fu_t1,yrs_dif
+    pairs_csv=os.path.join(working_dir,'long_pairwise_pairs.csv')
+    with open(pairs_csv,'w',newline='') as f:
+        writer=csv.writer(f,lineterminator='\n')
+        writer.writerow(['bl_t1','fu_t1','yrs_dif'])
+        for bl_t1_spm_path,(subject_label,fu_t1_spm_path,yrs_dif,out_dir,xfm_dir,report) in prepared.items():
+            writer.writerow([bl_t1_spm_path,fu_t1_spm_path,yrs_dif])
+
+    finished=[]
+    def finish(bl_t1_spm_path,entry):
+        #collect the outputs of a pair that ran, then free its scratch space
+        subject_label,fu_t1_spm_path,yrs_dif,out_dir,xfm_dir,report=prepared[bl_t1_spm_path]
+        if entry['status']=='ok':
+            collect_outputs(subject_label,working_dir,out_dir,xfm_dir,report)
+            finished.append((bl_t1_spm_path,entry))
+        else:
+            print(subject_label+' '+entry['status']+': '+entry['message'])
+        clean_subject(subject_label,working_dir)
+
+    #create SPM submit command for all pairs, then call it once
+    spm_cmd=spm_command("long_pairwise_job(\'"+pairs_csv+"\',[],[],\'"+spm_dir+"\',\'"+manifest+"\')")
+    print(spm_cmd)
+    batch_report=new_report(__file__)
+    done=set()
+    with stage(batch_report,'spm'):
+        #cpu_s of this stage includes the collection running alongside matlab
+        proc=subprocess.Popen(spm_cmd,shell=True)
+        while True:
+            running=proc.poll() is None
+            for bl_t1_spm_path,entry in read_manifest(manifest).items():
+                if bl_t1_spm_path in prepared and bl_t1_spm_path not in done:
+                    done.add(bl_t1_spm_path)
+                    finish(bl_t1_spm_path,entry)
+            if not running:
+                break
+            time.sleep(POLL_S)
+    #matlab time is shared out equally between subjects
+    spm_rec=dict(batch_report['stages']['spm'])
+    for key in ('wall_s','cpu_s','child_cpu_s'):
+        spm_rec[key]/=len(prepared)
+
+    #pairs missing from the manifest (matlab died) failed
+    for bl_t1_spm_path in prepared:
+        if bl_t1_spm_path not in done:
+            finish(bl_t1_spm_path,{'status':'missing','message':'not in manifest'})
+    for bl_t1_spm_path,entry in finished:
+        subject_label,fu_t1_spm_path,yrs_dif,out_dir,xfm_dir,report=prepared[bl_t1_spm_path]
+        report['stages']['spm']=dict(spm_rec,calls=1,pair_wall_s=float(entry['seconds']))
+        write_subject_report(report,subject_label,xfm_dir)
+    return n_failed+len(prepared)-len(finished)
+
+
+def run_batch(jobs_csv,data_root,working_dir,spm_dir,manifest,chunk_size=CHUNK_SIZE):
+    '''
+    register all subjects of a check_midpoint.py job csv, chunk_size subjects
+    per matlab session, returns the number of failed subjects
+    '''
+    with open(jobs_csv,newline='') as f:
+        rows=list(csv.DictReader(f))
+    print(str(len(rows))+' subjects in '+jobs_csv+', '+str(chunk_size)+' per matlab session')
+
+    #the manifest records this run only, matlab appends every chunk to it
+    if os.path.exists(manifest):
+        os.remove(manifest)
+    n_failed=0
+    for start in range(0,len(rows),chunk_size):
+        n_failed+=run_chunk(rows[start:start+chunk_size],data_root,working_dir,spm_dir,manifest)
+
+    print(str(len(rows)-n_failed)+' done, '+str(n_failed)+' failed, manifest: '+manifest)
+    return n_failed
+
+
+parser = argparse.ArgumentParser(description='Midpoint T1')
+parser.add_argument('--subject',type=str,
+                    help='Subject ID')
+parser.add_argument('--bl_session',type=str,
+                    help='Baseline PET-MR session')
+parser.add_argument('--fu_session',type=str,
+                    help='Followup PET-MR session')
+parser.add_argument('--bl_t1',type=str,
+                    help='Baseline T1 Scan ID to use')
+parser.add_argument('--fu_t1',type=str,
+                    help='Followup T1 Scan ID to use')
+parser.add_argument('--batch',type=str,
+                    help='Job csv from check_midpoint.py, all subjects in one matlab session')
+parser.add_argument('--manifest',type=str,
+                    help='Batch result manifest, default <job csv>_spm_manifest.csv')
+parser.add_argument('--chunk_size',type=int,default=CHUNK_SIZE,
+                    help='Batch subjects staged to scratch and registered per matlab session')
+parser.add_argument('--root_dir', type=str,
+                    default='/SAN/medic/insight46',
+                    help='Root directory')
+parser.add_argument('--spm_dir', type=str,
+                    help='SPM directory')
+parser.add_argument('--scratch_dir', type=str,
+                    help='Temp working directory')
+args=parser.parse_args()
+
+if args.root_dir:
+    data_root=args.root_dir
+else:
+    data_root='/SAN/medic/insight46'
+if args.spm_dir:
+    spm_dir=args.spm_dir
+else:
+    parser.error('Need --spm_dir')
+if args.scratch_dir:
+    working_dir=args.scratch_dir
+else:
+    parser.error('Need --scratch_dir')
+
+if args.batch:
+    if args.manifest:
+        manifest=args.manifest
+    else:
+        manifest=os.path.splitext(args.batch)[0]+'_spm_manifest.csv'
+    if run_batch(args.batch,data_root,working_dir,spm_dir,os.path.abspath(manifest),args.chunk_size):
+        exit(1)
+elif not args.bl_t1:
+    parser.error('Submit needs --bl_t1')
+elif not args.fu_t1:
+    parser.error('Submit needs --fu_t1')
+else:
+    subject_label='sub-' + args.subject
+    print('Subject label: ' + subject_label )
+    #wall/cpu time (including matlab), peak RSS and IO per stage
+    report=new_report(__file__,subject_label)
+    bl_t1_spm_path,fu_t1_spm_path,yrs_dif,out_dir,xfm_dir=prepare_subject(
+        subject_label,args.bl_session,args.fu_session,args.bl_t1,args.fu_t1,
+        data_root,working_dir,report)
+
+    #create SPM submit command, then call it
+    spm_cmd=spm_command("long_pairwise_job(\'"+bl_t1_spm_path+"\',\'"+fu_t1_spm_path+"\',"+str(yrs_dif)+",\'"+spm_dir+"\')")
+    print(spm_cmd)
+    with stage(report,'spm'):
+        subprocess.call(spm_cmd,shell=True)
+
+    collect_outputs(subject_label,working_dir,out_dir,xfm_dir,report)
+    write_subject_report(report,subject_label,xfm_dir)
 
         
     ### ANTs
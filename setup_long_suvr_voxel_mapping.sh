@@ -19,9 +19,9 @@ export FSLDIR PATH
 . ${FSLDIR}/etc/fslconf/fsl.sh
 FSLOUTPUTTYPE=NIFTI_GZ
 
-#R
+#R, only needed for --lts_engine R (LTS runs in python by default)
 #export PATH=/share/apps/R-3.5.2/bin:${PATH}
-export PATH=/share/apps/R-3.6.1/bin:${PATH}
+#export PATH=/share/apps/R-3.6.1/bin:${PATH}
 export FSLDIR
 
 export PATH
@@ -0,0 +1,215 @@
+'''
+Content-addressed cache of stage results (e.g. mapped voxel pairs)
+
+An entry is keyed on the sha256 of its input files and the stage parameters, so
+it is reused whenever the inputs are unchanged, whatever their path, and is
+never reused after an input changes. Entries are <key>.npz (arrays) and
+<key>.json (what produced it) in the cache dir, least recently used entries
+are evicted above a size limit.
+
+Jobs running at the same time (e.g. the array jobs of several recons) claim a
+missing entry with a <key>.lock file before computing it, the others wait for
+the entry instead of computing it again. A lock older than LOCK_STALE_S is
+left by a job that died and is taken over.
+
+usage: python stage_cache.py <cache dir> list
+       python stage_cache.py <cache dir> clear [subject]
+       python stage_cache.py <cache dir> evict <max GB>
+'''
+import hashlib
+import json
+import os
+import socket
+import sys
+import time
+import numpy as np
+
+DIGEST_FILE = 'digests.json'
+CHUNK = 1 << 20
+#seconds a job waits for an entry claimed by another job before computing it itself
+LOCK_WAIT_S = 3600
+#a claim older than this is from a job that died
+LOCK_STALE_S = 3600
+LOCK_POLL_S = 5
+
+
+def _write_json(path, obj):
+    #atomic, concurrent jobs share the cache dir
+    tmp = path + '.tmp' + str(os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(obj, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def file_digest(path):
+    #sha256 of the file contents
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(CHUNK), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def input_digests(cache_dir, paths):
+    '''
+    sha256 of each input file (dict name -> path), remembered in the cache dir
+    by path, size and mtime so unchanged files are not read again
+    '''
+    memo_path = os.path.join(cache_dir, DIGEST_FILE)
+    memo = {}
+    if os.path.exists(memo_path):
+        with open(memo_path) as f:
+            memo = json.load(f)
+    digests = {}
+    changed = False
+    for name, path in sorted(paths.items()):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        stamp = [st.st_size, st.st_mtime_ns]
+        if path in memo and memo[path][:2] == stamp:
+            digests[name] = memo[path][2]
+        else:
+            digests[name] = file_digest(path)
+            memo[path] = stamp + [digests[name]]
+            changed = True
+    if changed:
+        _write_json(memo_path, memo)
+    return digests
+
+
+def cache_key(digests, params):
+    #key of an entry from its input digests and stage parameters (json-able)
+    blob = json.dumps({'inputs': digests, 'params': params}, sort_keys=True)
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+
+def cache_get(cache_dir, key):
+    #arrays of entry key (dict), None if not cached
+    path = os.path.join(cache_dir, key + '.npz')
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as npz:
+        arrays = {name: npz[name] for name in npz.files}
+    #last use, for eviction
+    os.utime(path)
+    return arrays
+
+
+def cache_put(cache_dir, key, arrays, meta):
+    #store arrays (dict) as entry key, meta says what produced it
+    tmp = os.path.join(cache_dir, key + '.tmp' + str(os.getpid()) + '.npz')
+    np.savez_compressed(tmp, **arrays)
+    os.replace(tmp, os.path.join(cache_dir, key + '.npz'))
+    _write_json(os.path.join(cache_dir, key + '.json'), dict(meta, key=key, created=time.time()))
+
+
+def _lock_path(cache_dir, key):
+    return os.path.join(cache_dir, key + '.lock')
+
+
+def cache_claim(cache_dir, key, wait_s=LOCK_WAIT_S, stale_s=LOCK_STALE_S, poll_s=LOCK_POLL_S):
+    '''
+    claim entry key before computing it, waiting while another job holds it
+    returns True if this job holds the claim (cache_release it after
+    cache_put), False if the entry was stored meanwhile or the wait timed out
+    '''
+    lock = _lock_path(cache_dir, key)
+    entry = os.path.join(cache_dir, key + '.npz')
+    started = time.time()
+    while True:
+        if os.path.exists(entry):
+            return False
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                age = time.time() - os.path.getmtime(lock)
+            except OSError:
+                #released meanwhile
+                continue
+            if age > stale_s:
+                print('removing stale stage cache claim ' + lock)
+                try:
+                    os.remove(lock)
+                except OSError:
+                    pass
+                continue
+            if time.time() - started > wait_s:
+                return False
+            time.sleep(poll_s)
+            continue
+        with os.fdopen(fd, 'w') as f:
+            f.write(socket.gethostname() + ' ' + str(os.getpid()) + '\n')
+        return True
+
+
+def cache_release(cache_dir, key):
+    #drop the claim of entry key
+    try:
+        os.remove(_lock_path(cache_dir, key))
+    except OSError:
+        pass
+
+
+def _entries(cache_dir):
+    #(last use, size, key) of each entry, least recently used first
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.npz') and '.tmp' not in name:
+            st = os.stat(os.path.join(cache_dir, name))
+            entries.append((st.st_mtime, st.st_size, name[:-4]))
+    return sorted(entries)
+
+
+def _remove(cache_dir, key):
+    for ext in ('.npz', '.json'):
+        path = os.path.join(cache_dir, key + ext)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def cache_evict(cache_dir, max_bytes):
+    #remove least recently used entries until the cache is within max_bytes
+    entries = _entries(cache_dir)
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, key in entries:
+        if total <= max_bytes:
+            break
+        _remove(cache_dir, key)
+        total -= size
+        removed += 1
+    return removed
+
+
+def cache_meta(cache_dir, key):
+    path = os.path.join(cache_dir, key + '.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def cache_clear(cache_dir, subject=None):
+    #invalidate all entries, or those of one subject
+    removed = 0
+    for _, _, key in _entries(cache_dir):
+        if subject is None or cache_meta(cache_dir, key).get('subject') == subject:
+            _remove(cache_dir, key)
+            removed += 1
+    return removed
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[2] not in ('list', 'clear', 'evict'):
+        sys.exit(__doc__)
+    cache_dir, cmd = sys.argv[1:3]
+    if cmd == 'list':
+        for last_use, size, key in _entries(cache_dir):
+            meta = cache_meta(cache_dir, key)
+            print(key[:12], meta.get('subject'), meta.get('ref_roi'), size,
+                  time.strftime('%Y-%m-%d %H:%M', time.localtime(last_use)))
+    elif cmd == 'clear':
+        print('removed ' + str(cache_clear(cache_dir, sys.argv[3] if len(sys.argv) > 3 else None)))
+    else:
+        print('removed ' + str(cache_evict(cache_dir, float(sys.argv[3]) * 1e9)))
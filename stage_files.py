@@ -0,0 +1,68 @@
+'''
+Staging of NIfTI files between the SAN and scratch
+
+stage_in decompresses a .nii.gz straight from its source into scratch in one
+pass (no copy of the .gz to scratch first). stage_out compresses a scratch
+.nii straight into its final location, written under a temporary name in the
+destination dir and renamed into place, so a file with the final name is
+always complete. stage_out_all compresses several files at the same time in
+threads, zlib releases the GIL while compressing.
+'''
+import gzip
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+CHUNK = 1 << 22
+#gzip command line default
+COMPRESS_LEVEL = 6
+
+
+def _tmp_path(path):
+    #temporary name next to path, same file system so the rename is atomic
+    return os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + '.tmp' + str(os.getpid()))
+
+
+def stage_in(src, dst):
+    '''
+    write src (.nii.gz or .nii) to dst uncompressed, nothing is done if dst
+    already exists
+    '''
+    if os.path.exists(dst):
+        return dst
+    tmp = _tmp_path(dst)
+    try:
+        with (gzip.open(src, 'rb') if src.endswith('.gz') else open(src, 'rb')) as fin, \
+                open(tmp, 'wb') as fout:
+            shutil.copyfileobj(fin, fout, CHUNK)
+        os.replace(tmp, dst)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return dst
+
+
+def stage_out(src, dst, level=COMPRESS_LEVEL):
+    #compress src to dst (.gz), keeping the file name and mtime in the header as gzip does
+    tmp = _tmp_path(dst)
+    try:
+        with open(src, 'rb') as fin, open(tmp, 'wb') as raw, \
+                gzip.GzipFile(os.path.basename(dst), 'wb', level, raw, os.stat(src).st_mtime) as fout:
+            shutil.copyfileobj(fin, fout, CHUNK)
+        shutil.copystat(src, tmp)
+        os.replace(tmp, dst)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return dst
+
+
+def stage_out_all(files, workers=None, level=COMPRESS_LEVEL):
+    '''
+    stage_out each (src, dst) of files in parallel, one thread per file by
+    default, returns the dst paths
+    '''
+    if not files:
+        return []
+    with ThreadPoolExecutor(workers if workers else len(files)) as executor:
+        return list(executor.map(lambda pair: stage_out(pair[0], pair[1], level), files))
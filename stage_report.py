@@ -0,0 +1,159 @@
+'''
+Stage timing and memory report for the pipeline scripts
+
+Each stage records wall time, CPU time (this process and its subprocesses,
+e.g. matlab, gzip, Rscript), peak RSS and bytes read/written, repeated stages
+(e.g. one per reference region) are summed. The report is written per subject
+as json, the command line aggregates reports across the cohort to see where
+time goes and to size h_rt/tmem.
+
+usage: python stage_report.py <report json or dir> [...] [--csv out.csv]
+'''
+import contextlib
+import glob
+import json
+import os
+import resource
+import statistics
+import sys
+import time
+
+REPORT_SUFFIX = '_run_report.json'
+
+
+def _io_bytes():
+    #bytes read/written by this process (all reads/writes, including page cache)
+    try:
+        with open('/proc/self/io') as f:
+            io = dict(line.split(': ') for line in f.read().splitlines())
+        return int(io['rchar']), int(io['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def _usage():
+    self_ru = resource.getrusage(resource.RUSAGE_SELF)
+    child_ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+    read, written = _io_bytes()
+    return {'wall': time.perf_counter(),
+            'cpu': self_ru.ru_utime + self_ru.ru_stime,
+            'child_cpu': child_ru.ru_utime + child_ru.ru_stime,
+            #ru_maxrss is KB on linux, peak so far
+            'rss': self_ru.ru_maxrss / 1024.0,
+            'child_rss': child_ru.ru_maxrss / 1024.0,
+            'read': read, 'written': written}
+
+
+def new_report(script, subject=None):
+    return {'script': os.path.basename(script), 'subject': subject,
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'stages': {},
+            '_start': _usage()}
+
+
+@contextlib.contextmanager
+def stage(report, name):
+    '''
+    record the with block as stage name of report, report None records nothing
+    '''
+    if report is None:
+        yield
+        return
+    start = _usage()
+    try:
+        yield
+    finally:
+        end = _usage()
+        rec = report['stages'].setdefault(name, {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0,
+                                                 'child_cpu_s': 0.0, 'bytes_read': 0,
+                                                 'bytes_written': 0})
+        rec['calls'] += 1
+        rec['wall_s'] += end['wall'] - start['wall']
+        rec['cpu_s'] += end['cpu'] - start['cpu']
+        rec['child_cpu_s'] += end['child_cpu'] - start['child_cpu']
+        rec['bytes_read'] += end['read'] - start['read']
+        rec['bytes_written'] += end['written'] - start['written']
+        rec['peak_rss_mb'] = round(end['rss'], 1)
+        rec['child_peak_rss_mb'] = round(end['child_rss'], 1)
+
+
+def write_report(report, path):
+    #add totals and write the report as json, returns the total record
+    start = report['_start']
+    end = _usage()
+    out = {k: v for k, v in report.items() if k != '_start'}
+    out['total'] = {'wall_s': end['wall'] - start['wall'],
+                    'cpu_s': end['cpu'] - start['cpu'],
+                    'child_cpu_s': end['child_cpu'] - start['child_cpu'],
+                    'peak_rss_mb': round(end['rss'], 1),
+                    'child_peak_rss_mb': round(end['child_rss'], 1),
+                    'bytes_read': end['read'] - start['read'],
+                    'bytes_written': end['written'] - start['written']}
+    with open(path, 'w') as f:
+        json.dump(out, f, indent=1)
+    return out['total']
+
+
+def print_report(report):
+    #one line per stage so far
+    for name, rec in report['stages'].items():
+        print('stage {}: {:.1f}s wall, {:.1f}s cpu, {:.1f}s subprocess cpu, peak RSS {} MB'.format(
+            name, rec['wall_s'], rec['cpu_s'], rec['child_cpu_s'], rec['peak_rss_mb']))
+
+
+def find_reports(paths):
+    #report files from files and directories (searched recursively)
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found += sorted(glob.glob(os.path.join(path, '**', '*' + REPORT_SUFFIX), recursive=True))
+        else:
+            found.append(path)
+    return found
+
+
+def aggregate(reports):
+    '''
+    per script and stage (and total): number of subjects, median and max wall
+    time, median cpu, max peak RSS and median bytes read/written
+    '''
+    groups = {}
+    for report in reports:
+        stages = dict(report['stages'], total=report['total'])
+        for name, rec in stages.items():
+            groups.setdefault((report['script'], name), []).append(rec)
+    rows = []
+    for (script, name), recs in sorted(groups.items()):
+        col = lambda key: [rec.get(key, 0) for rec in recs]
+        rows.append({'script': script, 'stage': name, 'n': len(recs),
+                     'median_wall_s': round(statistics.median(col('wall_s')), 2),
+                     'max_wall_s': round(max(col('wall_s')), 2),
+                     'median_cpu_s': round(statistics.median(col('cpu_s')), 2),
+                     'median_child_cpu_s': round(statistics.median(col('child_cpu_s')), 2),
+                     'max_peak_rss_mb': max(col('peak_rss_mb')),
+                     'max_child_peak_rss_mb': max(col('child_peak_rss_mb')),
+                     'median_bytes_read': int(statistics.median(col('bytes_read'))),
+                     'median_bytes_written': int(statistics.median(col('bytes_written')))})
+    return rows
+
+
+if __name__ == '__main__':
+    import csv
+    argv = sys.argv[1:]
+    out_csv = None
+    if '--csv' in argv:
+        i = argv.index('--csv')
+        out_csv = argv[i + 1]
+        del argv[i:i + 2]
+    if not argv:
+        sys.exit(__doc__)
+    reports = []
+    for path in find_reports(argv):
+        with open(path) as f:
+            reports.append(json.load(f))
+    rows = aggregate(reports)
+    if not rows:
+        sys.exit('no reports found')
+    with (open(out_csv, 'w', newline='') if out_csv else contextlib.nullcontext(sys.stdout)) as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
@@ -0,0 +1,63 @@
+'''
+Voxel tables passed between the mapping and LTS stages
+
+Tables are named by their csv path (e.g. *_pet_uptake.csv). With format npz
+(compressed numpy) or parquet they are written next to it with that extension,
+with typed columns and the voxel coordinates; the csv, without coordinates, is
+then an optional export and is what the R script reads.
+'''
+import os
+import numpy as np
+import pandas as pd
+
+TABLE_FORMATS = ['csv', 'npz', 'parquet']
+
+#voxel coordinates, midpoint T1 and the mapped baseline/followup PET voxels
+COORD_COLUMNS = ['midpoint_i', 'midpoint_j', 'midpoint_k',
+                 'baseline_i', 'baseline_j', 'baseline_k',
+                 'followup_i', 'followup_j', 'followup_k']
+
+
+def table_path(csv_path, fmt):
+    #path of the table in format fmt
+    return os.path.splitext(csv_path)[0] + '.' + fmt
+
+
+def uptake_table(vox_values, mid_vox, bl_vox, fu_vox):
+    #typed *_pet_uptake table, voxel number 0 marks voxels dropped by dedup
+    df = pd.DataFrame({'voxel_number': vox_values[:, 0].astype(np.int32),
+                       'baseline_uptake': vox_values[:, 1],
+                       'followup_uptake': vox_values[:, 2]})
+    for name, vox in (('midpoint', mid_vox), ('baseline', bl_vox), ('followup', fu_vox)):
+        for axis, col in enumerate('ijk'):
+            df[name + '_' + col] = vox[:, axis].astype(np.int16)
+    return df
+
+
+def write_table(df, csv_path, fmt='csv', export_csv=False):
+    '''
+    write df as table csv_path in format fmt, also as csv if export_csv
+    the csv never has the coordinate columns
+    '''
+    if fmt == 'npz':
+        #strings as fixed width unicode so the file loads without pickle
+        columns = {c: df[c].to_numpy() for c in df.columns}
+        np.savez_compressed(table_path(csv_path, fmt),
+                            **{c: a.astype(str) if a.dtype == object else a
+                               for c, a in columns.items()})
+    elif fmt == 'parquet':
+        #needs pyarrow or fastparquet
+        df.to_parquet(table_path(csv_path, fmt), index=False)
+    if fmt == 'csv' or export_csv:
+        df.drop(columns=[c for c in COORD_COLUMNS if c in df.columns]).to_csv(csv_path, index=False)
+
+
+def read_table(csv_path, fmt='csv'):
+    #read table csv_path in format fmt, the csv if there is no fmt file (e.g. R output)
+    path = table_path(csv_path, fmt)
+    if fmt == 'npz' and os.path.exists(path):
+        with np.load(path) as npz:
+            return pd.DataFrame({c: npz[c] for c in npz.files})
+    if fmt == 'parquet' and os.path.exists(path):
+        return pd.read_parquet(path)
+    return pd.read_csv(csv_path)
@@ -48,6 +48,9 @@ FU_PET=`echo ${PROC} | cut -d, -f9`
 
 
 OUT_DIR=/SAN/medic/insight46/analysis/longitudinal_pet_voxel_mapping_${RECON}
+#stage cache shared by all recons, recons with the same PET grid and transform share the voxel mapping,
+#the array jobs of a subject's recons running at the same time wait for the first to map (stage_cache.py claims)
+CACHE_DIR=/SAN/medic/insight46/analysis/stage_cache
 SCRATCH_DIR=/scratch0/${USER}/${JOB_ID}.${SGE_TASK_ID}
 #SCRATCH_DIR=/SAN/medic/insight46/voxel_mapping_test/scratch/${USER}/${JOB_ID}.${SGE_TASK_ID}
 mkdir -p ${SCRATCH_DIR}
@@ -64,46 +67,18 @@ mkdir -p ${OUT_DIR}/sub-${SUBJECT}/ses-midpoint/pet
 
 #source /SAN/medic/insight46/scripts/setup_suvr_ref_mask.sh
 
-BL_INV_AFF=${OUT_DIR}/sub-${SUBJECT}/ses-baseline/xfm/sub-${SUBJECT}_ses-baseline_PET-to-T1.txt
-MID_TO_BL=${OUT_DIR}/sub-${SUBJECT}/ses-baseline/xfm/sub-${SUBJECT}_ses-baseline_MID-to-PET_mapping_def.nii.gz
-
-reg_transform -invAff $BL_AFF $BL_INV_AFF
-reg_transform -comp $BL_DEF $BL_INV_AFF $MID_TO_BL
-
-FU_INV_AFF=${OUT_DIR}/sub-${SUBJECT}/ses-followup/xfm/sub-${SUBJECT}_ses-followup_PET-to-T1.txt
-MID_TO_FU=${OUT_DIR}/sub-${SUBJECT}/ses-followup/xfm/sub-${SUBJECT}_ses-followup_MID-to-PET_mapping_def.nii.gz
-
-reg_transform -invAff $FU_AFF $FU_INV_AFF
-reg_transform -comp $FU_DEF $FU_INV_AFF $MID_TO_FU
-
-echo 'creating gm cereb mask in T1 space'
-
-T1_REF_MASK=${OUT_DIR}/sub-${SUBJECT}/ses-midpoint/anat/sub-${SUBJECT}_ses-midpoint_T1w_run-1_desc-gm-cereb-clean.nii.gz
-
-if [ ! -f $T1_REF_MASK ]; then
-    T1_SEG=/SAN/medic/insight46/analysis/gif/sub-${SUBJECT}/ses-midpoint/anat/sub-${SUBJECT}_ses-midpoint_T1w_run-1_desc-gradwarp_spm-midpoint_seg.nii.gz
-    workingmask=${SCRATCH_DIR}/sub-${SUBJECT}_ses-midpoint_T1w_run-1_desc-refmask.nii.gz
-    workingmask1=${SCRATCH_DIR}/sub-${SUBJECT}_ses-midpoint_T1w_run-1_desc-refmask1.nii.gz
-    #remake gm cereb clean mask as it wasn't saved before resampling to PET
-    #code used from scripts/submit_suvr_gm_cereb_refmask.sh
-    fslmaths ${MID_PAR} -thr 38.5 -uthr 40.5 -bin ${workingmask}
-    fslmaths ${MID_PAR} -thr 71.5 -uthr 74.5 -bin -add ${workingmask} -bin ${workingmask1}
-    #Clean it up a bit with the GM tissue - the labels themselves have
-    #already been cleaned with the DRC brainmask
-    seg_maths ${T1_SEG} -tp 2 -thr 0.9 -mul ${workingmask1} -bin -odt int ${T1_REF_MASK}
-    
-    rm -fv ${workingmask}
-    rm -fv ${workingmask1}
-else 
-    echo 'gm-cereb-clean mask already exists'
-fi
+#SPM def fields and T1 -> PET affines are composed in memory by the python script,
+#add --save_def to also write the MID-to-PET_mapping_def fields to xfm/
+
+#reference masks (cereb, gm-cereb-clean) are built from the parcellation and GIF
+#seg by the python script and cached in ses-midpoint/anat (see ref_masks.py)
+T1_SEG=/SAN/medic/insight46/analysis/gif/sub-${SUBJECT}/ses-midpoint/anat/sub-${SUBJECT}_ses-midpoint_T1w_run-1_desc-gradwarp_spm-midpoint_seg.nii.gz
 
 #source deactivate
 #source activate /SAN/medic/insight46/envs/long_suvr_voxel_mapping_2021_10_25
 
-for REF_ROI in cereb gm-cereb-clean ; do
-    
-    echo "python ${SCRIPTFILE} --subject ${SUBJECT} --mid_to_bl ${MID_TO_BL} --mid_to_fu ${MID_TO_FU} --mid_par ${MID_PAR} --bl_pet ${BL_PET} --fu_pet ${FU_PET} --ref_roi ${REF_ROI} --ref_roi_mask ${T1_REF_MASK} --root_dir ${OUT_DIR} --alpha 0.75"
-    python ${SCRIPTFILE} --subject ${SUBJECT} --mid_to_bl ${MID_TO_BL} --mid_to_fu ${MID_TO_FU} --mid_par ${MID_PAR} --bl_pet ${BL_PET} --fu_pet ${FU_PET} --ref_roi ${REF_ROI} --ref_roi_mask ${T1_REF_MASK} --root_dir ${OUT_DIR} --alpha 0.75
+#all reference regions mapped in one pass, inputs loaded once
+REF_ROIS="cereb gm-cereb-clean"
 
-done
+echo "python ${SCRIPTFILE} --subject ${SUBJECT} --bl_def ${BL_DEF} --bl_aff ${BL_AFF} --fu_def ${FU_DEF} --fu_aff ${FU_AFF} --mid_par ${MID_PAR} --bl_pet ${BL_PET} --fu_pet ${FU_PET} --ref_roi ${REF_ROIS} --mid_seg ${T1_SEG} --root_dir ${OUT_DIR} --cache_dir ${CACHE_DIR} --alpha 0.75"
+python ${SCRIPTFILE} --subject ${SUBJECT} --bl_def ${BL_DEF} --bl_aff ${BL_AFF} --fu_def ${FU_DEF} --fu_aff ${FU_AFF} --mid_par ${MID_PAR} --bl_pet ${BL_PET} --fu_pet ${FU_PET} --ref_roi ${REF_ROIS} --mid_seg ${T1_SEG} --root_dir ${OUT_DIR} --cache_dir ${CACHE_DIR} --alpha 0.75
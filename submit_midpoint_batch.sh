@@ -0,0 +1,42 @@
+#!/usr/bin/env bash
+#$ -S /bin/bash
+#$ -l h_rt=72:00:00
+#$ -l tmem=11G
+#$ -l h_vmem=11G
+#$ -j y
+#$ -b y
+#$ -cwd
+#$ -V
+#$ -R y
+#$ -o /SAN/medic/insight46/logs
+#$ -l tscratch=20G
+
+## Not an array job: the worklist is registered in matlab sessions of
+## --chunk_size subjects (one licence seat, matlab/SPM start up once per chunk),
+## each pair's scratch files are removed once collected, see run_midpoint.py --batch
+SCRATCH_DIR=/scratch0/${USER}/${JOB_ID}
+
+function finish {
+    date
+    rm -rf ${SCRATCH_DIR}
+}
+
+trap finish EXIT ERR
+
+mkdir -p ${SCRATCH_DIR}
+
+
+ROOT_DIR=/SAN/medic/insight46
+
+
+#SETUP
+source /SAN/medic/insight46/scripts/setup_midpoint.sh
+SCRIPTFILE=/SAN/medic/insight46/scripts/run_midpoint.py
+SPM_DIR='/home/wcoath/spm12_r6470/'
+INFILE=${1}
+
+echo ${HOSTNAME}
+
+#Call Python code
+echo "python ${SCRIPTFILE} --batch ${INFILE} --root_dir ${ROOT_DIR} --scratch_dir ${SCRATCH_DIR} --spm_dir ${SPM_DIR}"
+python ${SCRIPTFILE} --batch ${INFILE} --root_dir ${ROOT_DIR} --scratch_dir ${SCRATCH_DIR} --spm_dir ${SPM_DIR}
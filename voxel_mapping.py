@@ -0,0 +1,239 @@
+'''
+Batched voxel mapping helpers for run_long_suvr_voxel_mapping.py
+
+All functions work on whole arrays of ROI voxel coordinates at once instead of
+one voxel at a time.
+'''
+import itertools
+import resource
+import numpy as np
+import numpy.linalg as npl
+
+#bump when a change alters mapping results, cached mappings are then not reused
+MAPPING_VERSION = 2
+
+
+def label_roi(roi_mask):
+    '''
+    number the voxels of a binary ROI mask 1..nvox in the order np.nditer
+    visits them, i.e. memory order (Fortran order for nibabel data)
+    returns (labels, coords), coords is (nvox, 3) and row n is voxel n+1
+    '''
+    order = 'F' if roi_mask.flags.f_contiguous and not roi_mask.flags.c_contiguous else 'C'
+    flat = np.flatnonzero(roi_mask.ravel(order=order) == 1)
+    coords = np.column_stack(np.unravel_index(flat, roi_mask.shape, order=order))
+    labels = np.zeros(roi_mask.shape, dtype=np.int32, order=order)
+    labels[tuple(coords.T)] = np.arange(1, len(flat) + 1)
+    return labels, coords
+
+
+def label_coords(shape, coords):
+    #voxel number label volume (Fortran order, as nibabel data) from label_roi coords
+    labels = np.zeros(shape, dtype=np.int32, order='F')
+    labels[tuple(coords.T)] = np.arange(1, len(coords) + 1)
+    return labels
+
+
+def get_mm_def(def_data, coords):
+    #deformation vector (mm) at each voxel, def_data is x,y,z,3
+    i, j, k = coords.T
+    return def_data[i, j, k, :3]
+
+
+def load_data(img, lean=False):
+    #whole volume, native dtype if lean else float64 like get_fdata
+    return np.asanyarray(img.dataobj) if lean else img.get_fdata()
+
+
+def _bbox(vox):
+    #lower corner and slices of the bounding box of voxel coordinates
+    lo = vox.min(axis=0)
+    hi = vox.max(axis=0) + 1
+    return lo, tuple(slice(l, h) for l, h in zip(lo, hi))
+
+
+def read_block(img, vox):
+    '''
+    read only the bounding box of vox from the image proxy (memory mapped for
+    uncompressed files), native dtype
+    returns (block, vox relative to the block)
+    '''
+    if len(vox) == 0 or (vox < 0).any():
+        #negative indices wrap, read the whole volume
+        return np.asanyarray(img.dataobj), vox
+    lo, box = _bbox(vox)
+    return np.asanyarray(img.dataobj[box]), vox - lo
+
+
+def gather_def(def_img, coords):
+    #deformation vectors (mm) at coords, reading only the roi bounding box
+    block, rel = read_block(def_img, coords)
+    block = block.reshape(block.shape[:3] + (-1,))
+    return get_mm_def(block, rel).astype(float)
+
+
+def gather_values(img, vox):
+    #image values at voxel coordinates, reading only their bounding box of an image
+    if not hasattr(img, 'dataobj'):
+        return img[tuple(vox.T)].astype(float)
+    block, rel = read_block(img, vox)
+    return block[tuple(rel.T)].astype(float)
+
+
+def pet_geometry(img):
+    #grid of a PET image, all the voxel mapping depends on besides the transforms
+    return {'shape': list(img.shape[:3]), 'affine': np.round(img.affine, 6).tolist()}
+
+
+def peak_rss_mb():
+    #peak resident set size of this process so far, ru_maxrss is KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def mm2vox_float(affine, mm):
+    #continuous voxel coordinates in image with affine for each row of mm coordinates
+    inv_aff = npl.inv(affine)
+    M = inv_aff[:3, :3]
+    abc = inv_aff[:3, 3]
+    return mm.dot(M.T) + abc
+
+
+def mm2vox(affine, mm):
+    #nearest voxel in image with affine for each row of mm coordinates
+    return np.round(mm2vox_float(affine, mm)).astype(int)
+
+
+def load_affine_txt(path):
+    #4x4 NiftyReg affine text file (reference world -> floating world)
+    return np.loadtxt(path).reshape(4, 4)
+
+
+def pet_mapping_affine(pet_affine, t1_to_pet_aff=None):
+    '''
+    affine to pass to mm2vox for PET voxels
+    with t1_to_pet_aff the deformation holds T1 mm (SPM y_ field) rather than
+    PET mm, composing it with inv(t1_to_pet_aff) as reg_transform -invAff/-comp
+    did gives vox = inv(pet_affine) inv(aff) y = inv(aff pet_affine) y
+    '''
+    if t1_to_pet_aff is None:
+        return pet_affine
+    return t1_to_pet_aff.dot(pet_affine)
+
+
+def compose_def_affine(def_data, t1_to_pet_aff):
+    #whole deformation field (x,y,z,...,3 mm) composed with inv(t1_to_pet_aff)
+    inv_aff = npl.inv(t1_to_pet_aff)
+    return def_data.dot(inv_aff[:3, :3].T) + inv_aff[:3, 3]
+
+
+def _def_at(def_src, coords):
+    #def_src is a loaded x,y,z,3 array or a nibabel image read lazily
+    if hasattr(def_src, 'dataobj'):
+        return gather_def(def_src, coords)
+    return get_mm_def(def_src, coords)
+
+
+def map_roi_voxels(coords, mid_to_bl_data, mid_to_fu_data, bl_affine, fu_affine):
+    '''
+    map midpoint voxel coordinates to baseline and followup PET voxels
+    through the deformation fields, returns (bl_vox, fu_vox) both (nvox, 3)
+    deformations can be arrays or nibabel images (only roi box is read)
+    '''
+    bl_vox = mm2vox(bl_affine, _def_at(mid_to_bl_data, coords))
+    fu_vox = mm2vox(fu_affine, _def_at(mid_to_fu_data, coords))
+    return bl_vox, fu_vox
+
+
+def map_roi_points(coords, mid_to_bl_data, mid_to_fu_data, bl_affine, fu_affine):
+    #as map_roi_voxels but continuous (unrounded) PET voxel coordinates
+    bl_pts = mm2vox_float(bl_affine, _def_at(mid_to_bl_data, coords))
+    fu_pts = mm2vox_float(fu_affine, _def_at(mid_to_fu_data, coords))
+    return bl_pts, fu_pts
+
+
+def trilinear_values(src, pts):
+    '''
+    trilinear interpolation at continuous voxel coordinates pts (npts, 3),
+    neighbours outside the volume count as 0
+    src is a loaded array or a nibabel image (only the points bounding box is read)
+    '''
+    shape = np.array(src.shape[:3])
+    base = np.floor(pts).astype(int)
+    frac = pts - base
+    values = np.zeros(len(pts))
+    if len(pts) == 0:
+        return values
+    if hasattr(src, 'dataobj'):
+        lo = np.clip(base.min(axis=0), 0, shape - 1)
+        hi = np.clip(base.max(axis=0) + 2, lo + 1, shape)
+        data = np.asanyarray(src.dataobj[tuple(slice(l, h) for l, h in zip(lo, hi))])
+    else:
+        lo = np.zeros(3, dtype=int)
+        data = src
+    for corner in itertools.product((0, 1), repeat=3):
+        idx = base + corner
+        weight = np.prod(np.where(corner, frac, 1 - frac), axis=1)
+        inside = np.all((idx >= 0) & (idx < shape), axis=1)
+        values[inside] += weight[inside] * data[tuple((idx[inside] - lo).T)]
+    return values
+
+
+def label_nearest(mask, vox):
+    '''
+    label each voxel of mask with the first voxel number (row n is n+1) whose
+    nearest voxel it is, voxels outside the volume are skipped
+    '''
+    shape = mask.shape[:3]
+    n = np.flatnonzero(np.all((vox >= 0) & (vox < shape), axis=1))
+    _, first = np.unique(np.ravel_multi_index(tuple(vox[n].T), shape), return_index=True)
+    n = n[first]
+    mask[tuple(vox[n].T)] = n + 1
+    return mask
+
+
+def linear_index(vox, shape):
+    #linearised voxel index, negative indices wrap as in numpy indexing
+    return np.ravel_multi_index(tuple(vox.T), shape[:3], mode='wrap')
+
+
+def dedup_voxel_pairs(bl_vox, fu_vox, bl_shape, fu_shape):
+    '''
+    keep a midpoint voxel only if neither its baseline nor its followup PET
+    voxel has already been taken by an earlier (kept) midpoint voxel, so the
+    first midpoint voxel wins a PET voxel
+
+    returns boolean keep array (nvox,) and dict of collision counts
+    '''
+    bl_lin = linear_index(bl_vox, bl_shape).tolist()
+    fu_lin = linear_index(fu_vox, fu_shape).tolist()
+    keep = np.zeros(len(bl_lin), dtype=bool)
+    bl_taken = set()
+    fu_taken = set()
+    bl_collisions = 0
+    fu_collisions = 0
+    for n, (bl, fu) in enumerate(zip(bl_lin, fu_lin)):
+        bl_hit = bl in bl_taken
+        fu_hit = fu in fu_taken
+        if bl_hit or fu_hit:
+            bl_collisions += bl_hit
+            fu_collisions += fu_hit
+            continue
+        bl_taken.add(bl)
+        fu_taken.add(fu)
+        keep[n] = True
+    collisions = {'nvox': len(bl_lin),
+                  'kept': int(keep.sum()),
+                  'dropped': int(len(bl_lin) - keep.sum()),
+                  'baseline_collisions': bl_collisions,
+                  'followup_collisions': fu_collisions}
+    return keep, collisions
+
+
+def outlier_masks(outlier_vox, nvox, *label_volumes):
+    '''
+    boolean outlier mask for each volume labelled with voxel numbers 1..nvox
+    (0 background), using a lookup table indexed by voxel number
+    '''
+    lut = np.zeros(nvox + 1, dtype=bool)
+    lut[np.asarray(outlier_vox, dtype=int)] = True
+    return [lut[vol] for vol in label_volumes]
@@ -0,0 +1,106 @@
+'''
+Catalogue of XNAT sessions for the job checkers
+
+Queries go through one pooled requests.Session (keep-alive, retries) and an
+on-disk response cache: a response younger than the TTL is used without a
+request, an older one is revalidated with its ETag/Last-Modified (a 304 costs
+no download). Visits are paired per subject with a dict, so checking the
+cohort is linear in the number of sessions.
+
+The host is a parameter, the checkers can be pointed at a local stub XNAT
+serving /REST/experiments json.
+'''
+import hashlib
+import json
+import os
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+#seconds a cached response is used without asking the server
+TTL = 3600
+VISITS = {'01': 'baseline', '02': 'followup'}
+
+
+def xnat_session(headers=None, pool_size=4, retries=3):
+    #pooled HTTP session, retrying failed connections and server errors
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=1, status_forcelist=[500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if headers:
+        session.headers.update(headers)
+    return session
+
+
+def _cache_file(cache_dir, url):
+    return os.path.join(cache_dir, hashlib.sha256(url.encode()).hexdigest()[:32] + '.json')
+
+
+def _write_entry(path, entry):
+    #atomic, several checkers may share the cache
+    tmp = path + '.tmp' + str(os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(entry, f)
+    os.replace(tmp, path)
+
+
+def get_json(session, url, cache_dir=None, ttl=TTL):
+    '''
+    json body of url, from cache_dir if younger than ttl seconds or the
+    server answers 304 to its ETag/Last-Modified, no cache if cache_dir is None
+    '''
+    if cache_dir is None:
+        r = session.get(url)
+        r.raise_for_status()
+        return r.json()
+    os.makedirs(cache_dir, exist_ok=True)
+    path = _cache_file(cache_dir, url)
+    entry = None
+    if os.path.exists(path):
+        with open(path) as f:
+            entry = json.load(f)
+        if time.time() - entry['fetched'] < ttl:
+            return entry['body']
+    headers = {}
+    if entry is not None:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+    r = session.get(url, headers=headers)
+    if r.status_code == 304 and entry is not None:
+        entry['fetched'] = time.time()
+    else:
+        r.raise_for_status()
+        entry = {'url': url, 'etag': r.headers.get('ETag'),
+                 'last_modified': r.headers.get('Last-Modified'),
+                 'fetched': time.time(), 'body': r.json()}
+    _write_entry(path, entry)
+    return entry['body']
+
+
+def experiments(session, xnat_host, project, xsi_type, cache_dir=None, ttl=TTL):
+    #subject_label and label of each experiment of xsi_type in project, sorted by subject
+    url = xnat_host + '/REST/experiments?xsiType=' + xsi_type + '&project=' + project
+    result = get_json(session, url, cache_dir, ttl)['ResultSet']['Result']
+    return [{'subject_label': s['subject_label'], 'label': s['label']}
+            for s in sorted(result, key=lambda k: k['subject_label'])]
+
+
+def pair_visits(sessions):
+    '''
+    {subject_label: {'baseline': label, 'followup': label}} from sessions
+    labelled <...>_<visit>_..., visit 01 is baseline and 02 followup, the first
+    listed session of each visit is kept
+    '''
+    visits = {}
+    for session in sessions:
+        visit_id = session['label'].split('_')[1]
+        if visit_id not in VISITS:
+            print('Incorrect session label: ' + visit_id)
+            continue
+        visits.setdefault(session['subject_label'], {}).setdefault(VISITS[visit_id], session['label'])
+    return visits